@@ -0,0 +1,181 @@
+"""
+Recall vs latency of HNSW and IVFFlat indexes on a synthetic embedding corpus.
+
+    python benchmarks/ann_recall_benchmark.py [--rows 100000] [--dim 384] [--methods hnsw ivfflat]
+
+The corpus is clustered unit vectors (like sentence embeddings of a few courses),
+loaded into a scratch table (ann_recall_bench) with the service's layout: an untyped
+vector column, indexed per collection as a partial expression index on
+embedding::vector(dim), exactly as main.build_ann_indexes() builds it. Queries are
+perturbed corpus vectors; exact top-k is computed in NumPy and recall@k is the share
+of it each index returns. Uses the database from the service's DB_* environment.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+TABLE = "ann_recall_bench"
+INDEX = f"{TABLE}_ann_idx"
+COLLECTION = "00000000-0000-0000-0000-000000000001"
+
+
+def connect():
+    load_dotenv()
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST"),
+        port=os.environ.get("DB_PORT"),
+        dbname=os.environ.get("DB_NAME"),
+        user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD"),
+        sslmode="require",
+    )
+
+
+def to_pgvector(vec):
+    return "[" + ",".join(f"{x:.6f}" for x in vec) + "]"
+
+
+def synthetic_corpus(rows, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    corpus = centers[rng.integers(clusters, size=rows)] + rng.normal(scale=0.6, size=(rows, dim))
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    return corpus.astype(np.float32)
+
+
+def synthetic_queries(corpus, count, seed):
+    rng = np.random.default_rng(seed + 1)
+    queries = corpus[rng.integers(len(corpus), size=count)] + rng.normal(scale=0.05, size=(count, corpus.shape[1]))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype(np.float32)
+
+
+def exact_top_k(corpus, queries, k):
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, k, axis=1)[:, :k]
+    return [set(row.tolist()) for row in top]
+
+
+def load_corpus(cur, corpus):
+    cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cur.execute(f"CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY, collection_id UUID NOT NULL, embedding vector)")
+    batch = 20000
+    for start in range(0, len(corpus), batch):
+        buffer = io.StringIO()
+        for i, vec in enumerate(corpus[start:start + batch], start):
+            buffer.write(f"{i}\t{COLLECTION}\t{to_pgvector(vec)}\n")
+        buffer.seek(0)
+        cur.copy_from(buffer, TABLE, columns=("id", "collection_id", "embedding"))
+    cur.execute(f"ANALYZE {TABLE}")
+
+
+def build_index(cur, method, dim, options, memory):
+    cur.execute(f"DROP INDEX IF EXISTS {INDEX}")
+    cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (memory,))
+    with_clause = ", ".join(f"{key} = {value}" for key, value in options.items())
+    start = time.perf_counter()
+    cur.execute(f"""
+        CREATE INDEX {INDEX} ON {TABLE}
+        USING {method} ((embedding::vector({dim})) vector_cosine_ops)
+        WITH ({with_clause}) WHERE collection_id = '{COLLECTION}'::uuid
+    """)
+    elapsed = time.perf_counter() - start
+    cur.execute("SELECT pg_relation_size(%s::regclass)", (INDEX,))
+    return elapsed, cur.fetchone()[0]
+
+
+def run_queries(cur, queries, truth, dim, k, settings):
+    for setting, value in settings.items():
+        cur.execute("SELECT set_config(%s, %s, false)", (setting, str(value)))
+    latencies = []
+    recalls = []
+    for vec, expected in zip(queries, truth):
+        start = time.perf_counter()
+        cur.execute(f"""
+            SELECT id FROM {TABLE}
+            WHERE collection_id = '{COLLECTION}'::uuid
+            ORDER BY embedding::vector({dim}) <=> %s::vector({dim})
+            LIMIT %s
+        """, (to_pgvector(vec), k))
+        found = {row[0] for row in cur.fetchall()}
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(found & expected) / k)
+    latencies.sort()
+    return statistics.mean(recalls), statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def report(label, recall, p50, p95):
+    print(f"  {label:38} recall@k {recall:6.3f}   p50 {p50:8.2f} ms   p95 {p95:8.2f} ms")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="corpus size")
+    parser.add_argument("--dim", type=int, default=384, help="384 = MiniLM text, 512 = CLIP")
+    parser.add_argument("--clusters", type=int, default=200, help="topic clusters in the corpus")
+    parser.add_argument("--queries", type=int, default=100, help="queries per measurement")
+    parser.add_argument("--k", type=int, default=8, help="neighbours per query (retrieval uses 8)")
+    parser.add_argument("--methods", nargs="+", default=["hnsw", "ivfflat"], choices=["hnsw", "ivfflat"])
+    parser.add_argument("--m", type=int, nargs="+", default=[16, 32], help="HNSW m values")
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[64, 128], help="HNSW ef_construction values")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[20, 40, 80, 160], help="HNSW ef_search values")
+    parser.add_argument("--lists", type=int, nargs="+", default=[0], help="IVFFlat lists (0 = rows / 1000)")
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 5, 10, 20], help="IVFFlat probes values")
+    parser.add_argument("--build-memory", default="256MB", help="maintenance_work_mem for index builds")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch table afterwards")
+    args = parser.parse_args()
+
+    print(f"Generating {args.rows} x {args.dim} corpus and {args.queries} queries...")
+    corpus = synthetic_corpus(args.rows, args.dim, args.clusters, args.seed)
+    queries = synthetic_queries(corpus, args.queries, args.seed)
+    truth = exact_top_k(corpus, queries, args.k)
+
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        start = time.time()
+        load_corpus(cur, corpus)
+        print(f"Loaded in {time.time() - start:.0f}s\n")
+
+        print("exact scan")
+        report("no index", *run_queries(cur, queries, truth, args.dim, args.k, {}))
+
+        if "hnsw" in args.methods:
+            for m in args.m:
+                for ef_construction in args.ef_construction:
+                    elapsed, size = build_index(cur, "hnsw", args.dim, {"m": m, "ef_construction": ef_construction},
+                                                args.build_memory)
+                    print(f"\nhnsw m={m} ef_construction={ef_construction}: "
+                          f"built in {elapsed:.1f}s, {size / 1024 / 1024:.1f} MB")
+                    for ef_search in args.ef_search:
+                        report(f"ef_search={ef_search}",
+                               *run_queries(cur, queries, truth, args.dim, args.k, {"hnsw.ef_search": ef_search}))
+
+        if "ivfflat" in args.methods:
+            for lists in args.lists:
+                lists = lists or max(10, args.rows // 1000)
+                elapsed, size = build_index(cur, "ivfflat", args.dim, {"lists": lists}, args.build_memory)
+                print(f"\nivfflat lists={lists}: built in {elapsed:.1f}s, {size / 1024 / 1024:.1f} MB")
+                for probes in args.probes:
+                    report(f"probes={probes}",
+                           *run_queries(cur, queries, truth, args.dim, args.k, {"ivfflat.probes": probes}))
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        cur.close()
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
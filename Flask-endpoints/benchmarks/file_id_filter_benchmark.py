@@ -0,0 +1,146 @@
+"""
+Measure file_id-filtered query latency as the embedding table grows, with and
+without the metadata indexes main.ensure_metadata_indexes() creates.
+
+    python benchmarks/file_id_filter_benchmark.py [--sizes 10000 100000 1000000] [--files-per-1k 2]
+
+Works on a scratch copy of the langchain_pg_embedding layout (table
+file_id_filter_bench), filled with random vectors, in the database from the
+service's DB_* environment. The real tables are never touched. Queries:
+- knn:      nearest chunks for one file (the retrieval / LATERAL probe shape)
+- delete:   rows of three files across collections (delete / check-database shape)
+- contains: PGVector-style JSONB containment filter
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+TABLE = "file_id_filter_bench"
+INDEXES = {
+    f"{TABLE}_collection_file_id_idx": f"{TABLE} (collection_id, (cmetadata->>'file_id'))",
+    f"{TABLE}_file_id_idx": f"{TABLE} ((cmetadata->>'file_id'))",
+    f"{TABLE}_cmetadata_gin": f"{TABLE} USING GIN (cmetadata jsonb_path_ops)",
+}
+COLLECTIONS = ["00000000-0000-0000-0000-000000000001", "00000000-0000-0000-0000-000000000002"]
+
+
+def connect():
+    load_dotenv()
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST"),
+        port=os.environ.get("DB_PORT"),
+        dbname=os.environ.get("DB_NAME"),
+        user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD"),
+        sslmode="require",
+    )
+
+
+def create_table(cur, dim):
+    cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cur.execute(f"""
+        CREATE TABLE {TABLE} (
+            id VARCHAR PRIMARY KEY,
+            collection_id UUID NOT NULL,
+            embedding vector({dim}),
+            document VARCHAR,
+            cmetadata JSONB
+        )
+    """)
+
+
+def grow_table(cur, current_rows, target_rows, dim, files_per_1k):
+    """Append rows up to target_rows; each file owns a contiguous run of chunks"""
+    chunks_per_file = max(1, 1000 // files_per_1k)
+    batch = 50000
+    while current_rows < target_rows:
+        count = min(batch, target_rows - current_rows)
+        cur.execute(f"""
+            INSERT INTO {TABLE} (id, collection_id, embedding, document, cmetadata)
+            SELECT
+                'row-' || g,
+                (ARRAY[%s, %s]::uuid[])[1 + (g %% 2)],
+                (SELECT array_agg(random() + g * 0)::vector FROM generate_series(1, %s)),
+                'chunk ' || g,
+                jsonb_build_object('file_id', 'file-' || (g / %s), 'chunk_index', g %% %s)
+            FROM generate_series(%s, %s) AS g
+        """, (*COLLECTIONS, dim, chunks_per_file, chunks_per_file, current_rows, current_rows + count - 1))
+        current_rows += count
+    return current_rows, chunks_per_file
+
+
+def set_indexes(cur, enabled):
+    for name, definition in INDEXES.items():
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+        if enabled:
+            cur.execute(f"CREATE INDEX {name} ON {definition}")
+    cur.execute(f"ANALYZE {TABLE}")
+
+
+def time_queries(cur, rows, chunks_per_file, dim, repeat):
+    files = max(1, rows // chunks_per_file)
+    timings = {"knn": [], "delete": [], "contains": []}
+    for _ in range(repeat):
+        file_ids = [f"file-{random.randrange(files)}" for _ in range(3)]
+        query_vector = "[" + ",".join(f"{random.random():.4f}" for _ in range(dim)) + "]"
+        queries = {
+            "knn": (f"""
+                SELECT id FROM {TABLE}
+                WHERE collection_id = %s::uuid AND cmetadata->>'file_id' = ANY(%s)
+                ORDER BY embedding <=> %s::vector LIMIT 8
+            """, (COLLECTIONS[0], file_ids[:1], query_vector)),
+            "delete": (f"SELECT count(*) FROM {TABLE} WHERE cmetadata->>'file_id' = ANY(%s)", (file_ids,)),
+            "contains": (f"SELECT count(*) FROM {TABLE} WHERE cmetadata @> %s::jsonb", (f'{{"file_id": "{file_ids[0]}"}}',)),
+        }
+        for name, (sql, params) in queries.items():
+            start = time.perf_counter()
+            cur.execute(sql, params)
+            cur.fetchall()
+            timings[name].append((time.perf_counter() - start) * 1000)
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="table sizes to measure")
+    parser.add_argument("--dim", type=int, default=384, help="embedding dimension (384 = MiniLM)")
+    parser.add_argument("--files-per-1k", type=int, default=2, help="files per 1000 rows (default: 500 chunks per file)")
+    parser.add_argument("--repeat", type=int, default=20, help="queries per measurement (median is reported)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch table afterwards")
+    args = parser.parse_args()
+
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+    create_table(cur, args.dim)
+    rows = 0
+    print(f"{'rows':>10} {'query':9} {'no index ms':>12} {'indexed ms':>11} {'speedup':>8}")
+    try:
+        for size in sorted(args.sizes):
+            start = time.time()
+            rows, chunks_per_file = grow_table(cur, rows, size, args.dim, args.files_per_1k)
+            print(f"  ({rows} rows loaded in {time.time() - start:.0f}s)")
+            set_indexes(cur, enabled=False)
+            plain = time_queries(cur, rows, chunks_per_file, args.dim, args.repeat)
+            set_indexes(cur, enabled=True)
+            indexed = time_queries(cur, rows, chunks_per_file, args.dim, args.repeat)
+            for name in plain:
+                speedup = plain[name] / indexed[name] if indexed[name] else float("nan")
+                print(f"{rows:>10} {name:9} {plain[name]:12.2f} {indexed[name]:11.2f} {speedup:7.1f}x")
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        cur.close()
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -0,0 +1,97 @@
+"""
+Compare PDF extraction engines on a corpus of sample lecture PDFs.
+
+    python benchmarks/pdf_extraction_benchmark.py path/to/pdfs [--repeat 3]
+
+Engines:
+- legacy:     pdfplumber text + a second PyMuPDF open for images (the old two-pass path)
+- pymupdf:    extract_pdf_content single pass (default engine)
+- pdfplumber: extract_pdf_content with pdfplumber text (layout-fidelity mode)
+- parallel:   pymupdf sharded across the process pool (PDF_PARALLEL_WORKERS);
+              files under PDF_PARALLEL_MIN_PAGES pages run single-process
+
+Run from Flask-endpoints/ with the service's environment; importing main loads
+the embedding models, which is not part of the measured time.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Imported in main_benchmark(): spawned pool workers re-import this script as
+# __mp_main__ and must not load the models, DB pool and clients main sets up
+main = None
+
+
+def run_legacy(pdf_data):
+    text = main.extract_text_from_pdf(io.BytesIO(pdf_data))
+    images = main.extract_images_from_pdf(io.BytesIO(pdf_data))
+    return text, images
+
+
+def run_single_pass(pdf_data, engine, parallel=False):
+    text, images, _ = main.extract_pdf_content(pdf_data, engine=engine, parallel=parallel)
+    return text, images
+
+
+ENGINES = {
+    "legacy": run_legacy,
+    "pymupdf": lambda data: run_single_pass(data, "pymupdf"),
+    "pdfplumber": lambda data: run_single_pass(data, "pdfplumber"),
+    "parallel": lambda data: run_single_pass(data, "pymupdf", parallel=True),
+}
+
+
+def find_pdfs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(".pdf"):
+                    yield os.path.join(path, name)
+        elif path.lower().endswith(".pdf"):
+            yield path
+
+
+def main_benchmark():
+    global main
+    import main
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="PDF files or directories of PDFs")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per engine and file (median is reported)")
+    args = parser.parse_args()
+
+    pdfs = list(find_pdfs(args.paths))
+    if not pdfs:
+        print("No PDFs found")
+        return 1
+
+    totals = {engine: 0.0 for engine in ENGINES}
+    print(f"{'file':40} {'engine':11} {'median ms':>10} {'chars':>9} {'images':>7}")
+    for path in pdfs:
+        with open(path, "rb") as f:
+            pdf_data = f.read()
+        for engine, run in ENGINES.items():
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                text, images = run(pdf_data)
+                timings.append((time.perf_counter() - start) * 1000)
+            median = statistics.median(timings)
+            totals[engine] += median
+            print(f"{os.path.basename(path)[:40]:40} {engine:11} {median:10.1f} {len(text):9} {len(images):7}")
+
+    print("\nTotals (sum of medians):")
+    for engine, total in totals.items():
+        speedup = totals["legacy"] / total if total else float("nan")
+        print(f"  {engine:11} {total:10.1f} ms  ({speedup:.2f}x vs legacy)")
+    main.shut_down_pdf_process_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -0,0 +1,46 @@
+"""
+Deciding whether a question builds on the conversation before it.
+
+Kept separate from main.py so it can be checked without the embedding models,
+database pools and API clients main.py sets up at import time. /ask and
+/ask-stream answer standalone questions without chat history, which keeps their
+answers reusable from the answer cache; only follow-ups get the history.
+"""
+import re
+
+# "and what about X", "so does it ...", "why?", "go on": a question that continues the last one
+FOLLOW_UP_OPENERS = re.compile(
+    r"^\s*((and|but|so|also|then|or|what about|how about)\b|(why( not)?|go on|continue|keep going)\W*$)",
+    re.IGNORECASE,
+)
+
+# Explicit references to an earlier answer or requests to rework it
+FOLLOW_UP_PHRASES = re.compile(
+    r"\b("
+    r"you (said|say|mentioned|mention|wrote|meant|just)|your (last |previous )?answer|"
+    r"(previous|earlier|last|above) (answer|question|point|example|one)|"
+    r"more simply|simpler|in other words|rephrase|elaborate|expand on|"
+    r"explain (that|this|it|them|those)|tell me more|more detail|"
+    r"another example|give (me )?(an )?example of (that|this|it)|what do you mean"
+    r")\b",
+    re.IGNORECASE,
+)
+
+# Words that point back at something named earlier when the question itself is short
+REFERRING_WORDS = re.compile(r"\b(it|its|this|that|these|those|they|them|their|he|she)\b", re.IGNORECASE)
+SHORT_QUESTION_WORDS = 6
+
+
+def is_follow_up_question(question):
+    """
+    True when the question only makes sense with the previous turns: it opens
+    with a connective ("and what about..."), refers to an earlier answer
+    ("explain that more simply"), or is a short question leaning on a pronoun
+    ("why is it slower?"). Everything else is answered on its own.
+    """
+    question = question.strip()
+    if not question:
+        return False
+    if FOLLOW_UP_OPENERS.search(question) or FOLLOW_UP_PHRASES.search(question):
+        return True
+    return len(question.split()) <= SHORT_QUESTION_WORDS and bool(REFERRING_WORDS.search(question))
@@ -1,13 +1,29 @@
 import uuid
+import asyncio
 import subprocess
+import signal
+import shutil
 import tempfile
 import io,time
+import re
 import os
+import sys
+import json
+import threading
+import queue
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import base64
 import random
+import xmlrpc.client
 from datetime import datetime
 import uvicorn
 import boto3
+import numpy as np
 import fitz
 import pdfplumber
 from PIL import Image
@@ -19,18 +35,25 @@ from reportlab.lib.pagesizes import letter
 from typing import List
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from groq import Groq
+import httpx
+from groq import AsyncGroq, APIConnectionError, APIStatusError, RateLimitError
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_postgres import PGVector
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
 import psycopg2 as db
 from dotenv import load_dotenv
 from fastapi import Query
 
+import pdf_workers
+from chat_context import is_follow_up_question
+
 # ---------------- ENV & CONFIG ----------------
 load_dotenv()
 
@@ -39,6 +62,7 @@ CLIP_MODEL_NAME = "clip-ViT-B-32"
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 GROQ_MODEL = os.environ.get("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
 TABLE_NAME = "langchain_pg_embedding"
+COLLECTION_TABLE_NAME = "langchain_pg_collection"
 
 DB_HOST = os.environ.get("DB_HOST")
 DB_PORT = os.environ.get("DB_PORT")
@@ -70,22 +94,282 @@ app.add_middleware(
     allow_headers=["*"],
 )
 # ---------- Connect to hosted PostgreSQL ----------
+class DBConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+    - max_size: hard cap on open connections (idle + in use)
+    - acquire_timeout: seconds to wait for a free connection before giving up
+    - health_check_after: idle seconds after which a connection is pinged before reuse
+    """
+
+    def __init__(self, min_size, max_size, acquire_timeout, health_check_after, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self.connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._size = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._stats = {
+            "acquired": 0,
+            "acquire_timeouts": 0,
+            "connections_opened": 0,
+            "connections_discarded": 0,
+            "failed_health_checks": 0,
+            "connect_ms_total": 0.0,
+            "last_connect_ms": None,
+            "wait_ms_total": 0.0,
+        }
+
+    def _connect(self):
+        start = time.time()
+        connection = db.connect(**self.connect_kwargs)
+        elapsed_ms = (time.time() - start) * 1000
+        with self._cond:
+            self._stats["connections_opened"] += 1
+            self._stats["connect_ms_total"] += elapsed_ms
+            self._stats["last_connect_ms"] = round(elapsed_ms, 1)
+        return connection
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            cur = connection.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        connection, last_used = None, None
+        with self._cond:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # reserve a slot, connect outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["acquire_timeouts"] += 1
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for a database connection")
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            self._in_use += 1
+            self._stats["acquired"] += 1
+            self._stats["wait_ms_total"] += (time.monotonic() - start) * 1000
+
+        try:
+            if connection is not None and not self._is_healthy(connection, last_used):
+                with self._cond:
+                    self._stats["failed_health_checks"] += 1
+                    self._stats["connections_discarded"] += 1
+                self._close_quietly(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def release(self, connection, discard=False):
+        if not discard and not connection.closed:
+            try:
+                # Never hand out a connection with an open transaction
+                connection.rollback()
+            except Exception:
+                discard = True
+        if discard or connection.closed:
+            self._close_quietly(connection)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._stats["connections_discarded"] += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def prewarm(self):
+        """Open min_size connections up front so early requests skip the TLS handshake"""
+        connections = []
+        try:
+            for _ in range(self.min_size):
+                connections.append(self.acquire())
+        finally:
+            # Hand back whatever was opened, even if a later connect failed
+            for connection in connections:
+                self.release(connection)
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            opened = stats.pop("connections_opened")
+            acquired = stats["acquired"]
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiters": self._waiters,
+                "connections_opened": opened,
+                "avg_connect_ms": round(stats.pop("connect_ms_total") / opened, 1) if opened else None,
+                "avg_acquire_wait_ms": round(stats.pop("wait_ms_total") / acquired, 2) if acquired else None,
+                **stats,
+            }
+
+
+db_pool = DBConnectionPool(
+    min_size=int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+    max_size=int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+    acquire_timeout=float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", "10")),
+    health_check_after=float(os.environ.get("DB_POOL_HEALTH_CHECK_AFTER", "30")),
+    host=DB_HOST,
+    port=DB_PORT,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    sslmode="require"
+)
+
 print("Connecting to hosted PostgreSQL...")
-conn = None
 try:
-    conn = db.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        sslmode="require"
-    )
+    db_pool.prewarm()
     print("Connected to PostgreSQL!")
 except Exception as e:
     # Log the error but do not crash the entire app
     print("Failed to connect to PostgreSQL at startup:", e)
-    conn = None
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; uncommitted work is rolled back on release"""
+    connection = db_pool.acquire()
+    broken = False
+    try:
+        yield connection
+    except (db.OperationalError, db.InterfaceError):
+        broken = True
+        raise
+    finally:
+        db_pool.release(connection, discard=broken)
+
+# ---------- In-process caches ----------
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache.
+    - max_entries / max_bytes: eviction limits (either may be None)
+    - sizeof: function returning the size in bytes of a value, required with max_bytes
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return  # would evict everything else and still not fit
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                value, size = self._data.pop(key)
+                self._bytes -= size
+                return value
+            return None
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions
+            }
+
+class Counters:
+    """Thread-safe named counters for /status metrics, updated from request and worker threads"""
+
+    def __init__(self, **initial):
+        self._values = dict(initial)
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self._values[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
 
 # Load embedding models
 text_embeddings = HuggingFaceEmbeddings(model_name=EMBED_MODEL_NAME)
@@ -104,14 +388,71 @@ s3 = boto3.client(
     region_name=AWS_REGION
 )
 # ---------- PGVector ----------
+# One SQLAlchemy engine (and pool) shared by the text and CLIP collections
+PGVECTOR_POOL_SIZE = int(os.environ.get("PGVECTOR_POOL_SIZE", "5"))
+PGVECTOR_MAX_OVERFLOW = int(os.environ.get("PGVECTOR_MAX_OVERFLOW", "5"))
+PGVECTOR_POOL_PRE_PING = os.environ.get("PGVECTOR_POOL_PRE_PING", "true").lower() == "true"
+PGVECTOR_POOL_RECYCLE = int(os.environ.get("PGVECTOR_POOL_RECYCLE", "1800"))  # seconds
+PGVECTOR_STATEMENT_TIMEOUT_MS = int(os.environ.get("PGVECTOR_STATEMENT_TIMEOUT_MS", "30000"))
+
+vector_engine = None
+vector_engine_lock = threading.Lock()
 vector_store = None
 clip_vector_store = None
 
+def get_vector_engine():
+    global vector_engine
+    with vector_engine_lock:
+        if vector_engine is None:
+            vector_engine = create_engine(
+                URL.create(
+                    "postgresql+psycopg2",
+                    username=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    database=DB_NAME
+                ),
+                pool_size=PGVECTOR_POOL_SIZE,
+                max_overflow=PGVECTOR_MAX_OVERFLOW,
+                pool_pre_ping=PGVECTOR_POOL_PRE_PING,
+                pool_recycle=PGVECTOR_POOL_RECYCLE,
+                connect_args={
+                    "sslmode": "require",
+                    "options": f"-c statement_timeout={PGVECTOR_STATEMENT_TIMEOUT_MS}"
+                }
+            )
+    return vector_engine
+
+def get_vector_engine_metrics():
+    if vector_engine is None:
+        return {"initialized": False}
+    pool = vector_engine.pool
+    return {
+        "initialized": True,
+        "pool_size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": PGVECTOR_MAX_OVERFLOW
+    }
+
+def prewarm_vector_stores():
+    """Build both PGVector stores and fill the engine pool before traffic arrives"""
+    start = time.time()
+    get_vector_store()
+    get_clip_vector_store()
+    engine = get_vector_engine()
+    connections = [engine.connect() for _ in range(PGVECTOR_POOL_SIZE)]
+    for connection in connections:
+        connection.close()
+    print(f"Vector stores ready, {len(connections)} pooled connections in {(time.time() - start) * 1000:.0f} ms")
+
 def get_vector_store():
     global vector_store
     if vector_store is None:
         vector_store = PGVector(
-            connection=f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require",
+            connection=get_vector_engine(),
             collection_name=TABLE_NAME,
             embeddings=text_embeddings,
             distance_strategy="cosine",
@@ -120,6 +461,218 @@ def get_vector_store():
         )
     return vector_store
 
+# ---------- Embedding table indexes ----------
+# Both collections share one table and every per-file query filters on
+# cmetadata->>'file_id', so that expression is indexed (alone and after collection_id),
+# plus a jsonb_path_ops GIN index for PGVector's JSONB containment filters.
+metadata_indexes_ready = False
+
+def create_indexes_concurrently(indexes, rebuild=False, drop=(), session_settings=None):
+    """
+    Build indexes ({name: "table USING ... (...)"}) with CREATE INDEX CONCURRENTLY, so a
+    live table keeps taking writes. It cannot run in a transaction, hence autocommit.
+    An index left INVALID by an interrupted build is dropped and rebuilt.
+    - rebuild: also drop and rebuild valid indexes (e.g. to apply new build parameters)
+    - drop: names of indexes to drop first
+    - session_settings: {setting: value} applied for the builds, e.g. maintenance_work_mem
+    Returns {name: build ms} for the indexes actually built.
+    """
+    built = {}
+    with db_connection() as conn:
+        conn.rollback()
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            for setting, value in (session_settings or {}).items():
+                cur.execute("SELECT set_config(%s, %s, false)", (setting, str(value)))
+            for name in drop:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            for name, definition in indexes.items():
+                cur.execute("""
+                    SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+                    WHERE c.relname = %s
+                """, (name,))
+                row = cur.fetchone()
+                if row is not None and row[0] and not rebuild:
+                    continue
+                if row is not None:
+                    print(f"  Rebuilding {'index' if row[0] else 'invalid index'} {name}")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                start = time.time()
+                cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+                built[name] = round((time.time() - start) * 1000)
+                print(f"  Index {name} built in {built[name]} ms")
+        finally:
+            for setting in (session_settings or {}):
+                cur.execute(f"RESET {setting}")
+            cur.close()
+            conn.autocommit = False
+    return built
+
+def ensure_metadata_indexes():
+    global metadata_indexes_ready
+    if metadata_indexes_ready:
+        return True
+    try:
+        create_indexes_concurrently({
+            # Collection-scoped lookups (retrieval, cloning, PGVector filters)
+            f"{TABLE_NAME}_collection_file_id_idx": f"{TABLE_NAME} (collection_id, (cmetadata->>'file_id'))",
+            # Lookups across both collections (deletes, /check-database)
+            f"{TABLE_NAME}_file_id_idx": f"{TABLE_NAME} ((cmetadata->>'file_id'))",
+            # Same name PGVector uses when it creates the table itself, so it is never built twice
+            "ix_cmetadata_gin": f"{TABLE_NAME} USING GIN (cmetadata jsonb_path_ops)"
+        })
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # Expression indexes only get planner statistics after an ANALYZE
+            cur.execute(f"ANALYZE {TABLE_NAME}")
+            conn.commit()
+            cur.close()
+        metadata_indexes_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring metadata indexes: {e}")
+        return False
+
+# ---------- Approximate nearest-neighbour indexes ----------
+# The embedding column is an untyped vector shared by the 384-dim text and 512-dim CLIP
+# collections, so each collection gets a partial expression index on embedding::vector(dim).
+# Only queries that compare that same expression (and filter on the collection) can use it.
+# File-scoped queries deliberately compare the raw column: an ANN scan would fetch the
+# ef_search nearest rows of the whole collection and filter by file_id afterwards,
+# returning fewer than k rows. The indexes are meant for collection-wide queries, which
+# the service does not run yet; benchmarks/ann_recall_benchmark.py measures their recall
+# and the ef_search / probes settings such a query would need.
+ANN_INDEX_METHOD = os.environ.get("ANN_INDEX_METHOD", "hnsw").lower()  # hnsw | ivfflat
+ANN_INDEX_AUTO_BUILD = os.environ.get("ANN_INDEX_AUTO_BUILD", "false").lower() == "true"
+ANN_INDEX_BUILD_MEMORY = os.environ.get("ANN_INDEX_BUILD_MEMORY", "256MB")  # maintenance_work_mem for builds
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+IVFFLAT_LISTS = int(os.environ.get("IVFFLAT_LISTS", "0"))  # 0 = derived from the row count
+ANN_INDEX_METHODS = ("hnsw", "ivfflat")
+
+ann_index_build = {"running": False, "started_at": None, "finished_at": None, "params": None, "built_ms": None, "error": None}
+ann_index_build_lock = threading.Lock()
+
+def ann_index_collections():
+    """Collections with an ANN index: name -> (short name, dimension)"""
+    return {
+        TABLE_NAME: ("text", EMBED_DIM),
+        f"{TABLE_NAME}_clip": ("clip", CLIP_EMBED_DIM)
+    }
+
+def ann_index_name(short_name, method):
+    return f"{TABLE_NAME}_{short_name}_{method}_idx"
+
+def ivfflat_lists_for(rows):
+    """pgvector's guidance: rows / 1000 lists up to 1M rows, sqrt(rows) beyond"""
+    if rows <= 1000000:
+        return max(10, rows // 1000)
+    return int(rows ** 0.5)
+
+def build_ann_indexes(method=None, m=None, ef_construction=None, lists=None, rebuild=False):
+    """
+    Build the ANN index of every collection with the given (or configured) parameters.
+    The other method's index is dropped, so a collection never carries both.
+    """
+    method = method or ANN_INDEX_METHOD
+    if method not in ANN_INDEX_METHODS:
+        raise ValueError(f"Unknown ANN index method: {method}")
+    m = m or HNSW_M
+    ef_construction = ef_construction or HNSW_EF_CONSTRUCTION
+
+    indexes = {}
+    drop = []
+    params = {"method": method, "collections": {}}
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for collection_name, (short_name, dim) in ann_index_collections().items():
+            collection_id = get_collection_id(cur, collection_name)
+            if collection_id is None:
+                continue
+            if method == "hnsw":
+                options = {"m": m, "ef_construction": ef_construction}
+            else:
+                cur.execute(f"SELECT count(*) FROM {TABLE_NAME} WHERE collection_id = %s::uuid", (collection_id,))
+                options = {"lists": lists or IVFFLAT_LISTS or ivfflat_lists_for(cur.fetchone()[0])}
+            with_clause = ", ".join(f"{key} = {int(value)}" for key, value in options.items())
+            indexes[ann_index_name(short_name, method)] = (
+                f"{TABLE_NAME} USING {method} ((embedding::vector({dim})) vector_cosine_ops) "
+                f"WITH ({with_clause}) WHERE collection_id = '{collection_id}'::uuid"
+            )
+            drop += [ann_index_name(short_name, other) for other in ANN_INDEX_METHODS if other != method]
+            params["collections"][collection_name] = options
+        cur.close()
+        conn.commit()
+
+    built = create_indexes_concurrently(
+        indexes, rebuild=rebuild, drop=drop,
+        session_settings={"maintenance_work_mem": ANN_INDEX_BUILD_MEMORY}
+    )
+    return params, built
+
+def run_ann_index_build(**params):
+    """Background build reported through ann_index_build; returns False if one is already running"""
+    with ann_index_build_lock:
+        if ann_index_build["running"]:
+            return False
+        ann_index_build.update(running=True, started_at=datetime.now().isoformat(), finished_at=None,
+                               params=None, built_ms=None, error=None)
+
+    def build():
+        try:
+            applied, built = build_ann_indexes(**params)
+            ann_index_build.update(params=applied, built_ms=built)
+        except Exception as e:
+            print(f"Error building ANN indexes: {e}")
+            ann_index_build["error"] = str(e)
+        finally:
+            ann_index_build.update(running=False, finished_at=datetime.now().isoformat())
+
+    threading.Thread(target=build, name="ann-index-build", daemon=True).start()
+    return True
+
+def describe_ann_indexes():
+    """Existing ANN indexes with their size and validity, plus build progress if one is running"""
+    names = [ann_index_name(short_name, method)
+             for short_name, _ in ann_index_collections().values() for method in ANN_INDEX_METHODS]
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.relname, am.amname, i.indisvalid, pg_relation_size(c.oid), c.reloptions
+            FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE c.relname = ANY(%s)
+        """, (names,))
+        indexes = [{
+            "name": r[0],
+            "method": r[1],
+            "valid": r[2],
+            "size_bytes": r[3],
+            "options": dict(option.split("=", 1) for option in (r[4] or []))
+        } for r in cur.fetchall()]
+        cur.execute("""
+            SELECT c.relname, p.phase, p.blocks_done, p.blocks_total, p.tuples_done, p.tuples_total
+            FROM pg_stat_progress_create_index p
+            JOIN pg_class c ON c.oid = p.relid
+            WHERE c.relname = %s
+        """, (TABLE_NAME,))
+        progress = [{
+            "phase": r[1],
+            "blocks_done": r[2],
+            "blocks_total": r[3],
+            "tuples_done": r[4],
+            "tuples_total": r[5]
+        } for r in cur.fetchall()]
+        cur.close()
+        conn.commit()
+    return {
+        "indexes": indexes,
+        "build": dict(ann_index_build),
+        "build_progress": progress
+    }
+
 # Import Office document libraries
 try:
     DOCX_SUPPORT = True
@@ -147,19 +700,31 @@ except ImportError:
     print("PDF support disabled: install pdfplumber")
 
 
+CLIP_BATCH_SIZE = int(os.environ.get("CLIP_BATCH_SIZE", "64"))
+
+class ClipEmbeddings:
+    """LangChain embeddings adapter around the CLIP text encoder"""
+
+    def embed_documents(self, texts):
+        # One forward pass per CLIP_BATCH_SIZE texts; rows stay numpy arrays,
+        # which pgvector binds directly in PGVector's multi-row INSERT
+        embeddings = clip_model.encode(
+            list(texts),
+            batch_size=CLIP_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return list(embeddings)
+    
+    def embed_query(self, text):
+        return clip_model.encode([text], convert_to_numpy=True)[0].tolist()
+
 def get_clip_vector_store():
     global clip_vector_store
     if clip_vector_store is None:
-        class ClipEmbeddings:
-            def embed_documents(self, texts):
-                return [self.embed_query(text) for text in texts]
-            
-            def embed_query(self, text):
-                return clip_model.encode([text])[0].tolist()
-        
         clip_embeddings = ClipEmbeddings()
         clip_vector_store = PGVector(
-            connection=f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require",
+            connection=get_vector_engine(),
             collection_name=f"{TABLE_NAME}_clip",
             embeddings=clip_embeddings,
             distance_strategy="cosine",
@@ -169,7 +734,443 @@ def get_clip_vector_store():
         )
     return clip_vector_store
 
-def retrieve_by_file_ids(file_ids, query, k=8):
+# ---------- Retrieval probe terms ----------
+VISUAL_PROBE_TERMS = ["image", "diagram", "chart", "graph", "figure", "photo", "picture", "illustration"]
+FLASHCARD_SEARCH_TERMS = [
+    "key concepts",
+    "important information",
+    "main topics",
+    "detailed explanations",
+]
+MCQ_SEARCH_TERMS = [
+    "key concepts definitions important points",
+    "formulas equations calculations data",
+    "diagrams images charts visual information",
+    "processes methods steps procedures",
+    "facts information details explanations"
+]
+ENHANCE_NOTES_SEARCH_TERMS = ["comprehensive understanding", "detailed information", "key concepts visual content"]
+
+PROBE_TERMS = list(dict.fromkeys(
+    VISUAL_PROBE_TERMS + FLASHCARD_SEARCH_TERMS + MCQ_SEARCH_TERMS + ENHANCE_NOTES_SEARCH_TERMS
+))
+
+# Embeddings of the constant probe terms, filled at startup and kept for the process lifetime
+probe_embeddings = {"text": {}, "clip": {}}
+
+def warm_probe_embeddings():
+    """Embed every constant probe term once with MiniLM and CLIP"""
+    start = time.time()
+    text_vectors = text_embeddings.embed_documents(PROBE_TERMS)
+    clip_vectors = clip_model.encode(PROBE_TERMS, batch_size=CLIP_BATCH_SIZE, convert_to_numpy=True)
+    for term, text_vec, clip_vec in zip(PROBE_TERMS, text_vectors, clip_vectors):
+        probe_embeddings["text"][term] = text_vec
+        probe_embeddings["clip"][term] = clip_vec
+    print(f"Cached embeddings for {len(PROBE_TERMS)} probe terms in {(time.time() - start) * 1000:.0f} ms")
+
+query_embedding_cache = LRUCache(max_entries=256)  # recent questions, embedded once per request path
+
+def get_text_query_embedding(query):
+    """MiniLM embedding for a query, served from the probe registry when the query is a constant term"""
+    cached = probe_embeddings["text"].get(query)
+    if cached is None:
+        cached = query_embedding_cache.get(query)
+    if cached is not None:
+        return cached
+    embedding = text_embeddings.embed_query(query)
+    if query in PROBE_TERMS:
+        probe_embeddings["text"][query] = embedding
+    else:
+        query_embedding_cache.put(query, embedding)
+    return embedding
+
+def encode_clip_probes(texts):
+    """CLIP embeddings for probe texts; constant terms come from the registry, the rest share one encode call"""
+    vectors = [probe_embeddings["clip"].get(text) for text in texts]
+    missing = [i for i, vec in enumerate(vectors) if vec is None]
+    if missing:
+        encoded = clip_model.encode([texts[i] for i in missing], batch_size=CLIP_BATCH_SIZE, convert_to_numpy=True)
+        for i, vec in zip(missing, encoded):
+            vectors[i] = vec
+            if texts[i] in PROBE_TERMS:
+                probe_embeddings["clip"][texts[i]] = vec
+    return vectors
+
+# PGVector keeps every collection in one embedding table, keyed by collection uuid
+collection_ids = {}
+
+def get_collection_id(cur, collection_name):
+    """Look up (and remember) the uuid of a PGVector collection"""
+    if collection_name not in collection_ids:
+        cur.execute(f"SELECT uuid FROM {COLLECTION_TABLE_NAME} WHERE name = %s", (collection_name,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        collection_ids[collection_name] = str(row[0])
+    return collection_ids[collection_name]
+
+def to_pgvector(embedding):
+    """Format an embedding as a pgvector text literal"""
+    return "[" + ",".join(map(str, embedding)) + "]"
+
+# Filter-first exact search: scoped queries touch one to a few files (a few hundred chunks),
+# so their vectors are fetched once through the file_id index, kept per file, and scored
+# in-process with one matrix product. Results are the exact top-k, and an ANN index scan
+# can never filter a file's rows out after the fact.
+EXACT_SEARCH = os.environ.get("EXACT_SEARCH", "true").lower() == "true"
+EXACT_SEARCH_MAX_ROWS = int(os.environ.get("EXACT_SEARCH_MAX_ROWS", "20000"))  # larger scopes are searched in SQL
+FILE_MATRIX_CACHE_MAX_BYTES = int(os.environ.get("FILE_MATRIX_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+FILE_MATRIX_DTYPE = np.float16 if os.environ.get("FILE_MATRIX_DTYPE", "float32").lower() == "float16" else np.float32
+
+def file_matrix_size(entry):
+    """Bytes held by a cached file: the matrix plus its row id and chunk text lists, object overhead included"""
+    ids, documents, matrix = entry
+    return (
+        matrix.nbytes
+        + sys.getsizeof(ids) + sum(sys.getsizeof(row_id) for row_id in ids)
+        + sys.getsizeof(documents) + sum(sys.getsizeof(document) for document in documents)
+    )
+
+# (collection name, file_id) -> (row ids, chunk texts, L2-normalised FILE_MATRIX_DTYPE matrix)
+file_matrix_cache = LRUCache(max_bytes=FILE_MATRIX_CACHE_MAX_BYTES, sizeof=file_matrix_size)
+file_matrix_cache_stats = Counters(warmed=0, invalidated=0)
+# Bumped whenever a file's cached matrices are invalidated; a load that started before the
+# bump must not cache what it read (e.g. rows of a file that was still being ingested)
+file_matrix_generations = {}
+file_matrix_generation_lock = threading.Lock()
+
+def parse_pgvector(text):
+    return np.array(text[1:-1].split(","), dtype=np.float32)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def load_file_matrices(collection_name, file_ids):
+    """
+    {file_id: (row ids, documents, matrix)} for the given files of a collection.
+    Cached files are served from file_matrix_cache, the rest are fetched in one query.
+    Files without rows are left out. Returns None when the scope exceeds EXACT_SEARCH_MAX_ROWS.
+    """
+    found = {}
+    missing = []
+    for file_id in file_ids:
+        entry = file_matrix_cache.get((collection_name, file_id))
+        if entry is None:
+            missing.append(file_id)
+        else:
+            found[file_id] = entry
+    cached_rows = sum(len(entry[0]) for entry in found.values())
+    if cached_rows > EXACT_SEARCH_MAX_ROWS:
+        return None
+    if not missing:
+        return found
+
+    with file_matrix_generation_lock:
+        generations = {file_id: file_matrix_generations.get(file_id, 0) for file_id in missing}
+    rows = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        collection_id = get_collection_id(cur, collection_name)
+        if collection_id is not None:
+            cur.execute(f"""
+                SELECT cmetadata->>'file_id', id, document, embedding::text
+                FROM {TABLE_NAME}
+                WHERE collection_id = %s::uuid AND cmetadata->>'file_id' = ANY(%s)
+                ORDER BY 1, id
+                LIMIT %s
+            """, (collection_id, missing, EXACT_SEARCH_MAX_ROWS - cached_rows + 1))
+            rows = cur.fetchall()
+        cur.close()
+        conn.commit()
+    if cached_rows + len(rows) > EXACT_SEARCH_MAX_ROWS:
+        return None
+
+    grouped = {}
+    for file_id, row_id, document, embedding in rows:
+        grouped.setdefault(file_id, []).append((row_id, document, embedding))
+    for file_id, file_rows in grouped.items():
+        matrix = normalize_rows(np.vstack([parse_pgvector(row[2]) for row in file_rows])).astype(FILE_MATRIX_DTYPE)
+        entry = ([row[0] for row in file_rows], [row[1] for row in file_rows], matrix)
+        with file_matrix_generation_lock:
+            if file_matrix_generations.get(file_id, 0) == generations[file_id]:
+                file_matrix_cache.put((collection_name, file_id), entry)
+        found[file_id] = entry
+    return found
+
+def exact_search(collection_name, file_ids, probe_vectors, ks):
+    """
+    Exact cosine nearest neighbours among the rows of the given files.
+    - probe_vectors / ks: one query vector and result count per probe
+    Returns one list of (row id, document, similarity) per probe, best first,
+    or None when the files hold too many rows to search in-process.
+    """
+    matrices = load_file_matrices(collection_name, file_ids)
+    if matrices is None:
+        return None
+    if not matrices:
+        return [[] for _ in probe_vectors]
+
+    entries = list(matrices.values())
+    ids = [row_id for entry in entries for row_id in entry[0]]
+    documents = [document for entry in entries for document in entry[1]]
+    matrix = entries[0][2] if len(entries) == 1 else np.vstack([entry[2] for entry in entries])
+    # float16 storage halves memory; the product runs in float32, which BLAS handles fast
+    matrix = matrix.astype(np.float32, copy=False)
+
+    scores = normalize_rows(np.asarray(probe_vectors, dtype=np.float32)) @ matrix.T
+    results = []
+    for row, probe_k in zip(scores, ks):
+        probe_k = min(probe_k, len(row))
+        if probe_k <= 0:
+            results.append([])
+            continue
+        top = np.argpartition(-row, probe_k - 1)[:probe_k]
+        top = top[np.argsort(-row[top])]
+        results.append([(ids[i], documents[i], float(row[i])) for i in top])
+    return results
+
+def invalidate_file_matrices(file_ids):
+    """Drop cached matrices of the given files in every collection (deleted, re-indexed or just ingested)"""
+    with file_matrix_generation_lock:
+        for file_id in file_ids:
+            file_matrix_generations[file_id] = file_matrix_generations.get(file_id, 0) + 1
+            for collection_name in (TABLE_NAME, f"{TABLE_NAME}_clip"):
+                if file_matrix_cache.pop((collection_name, file_id)) is not None:
+                    file_matrix_cache_stats.add("invalidated")
+
+def warm_file_matrices(file_ids):
+    """Load freshly indexed files into the cache, replacing anything read while they were being ingested"""
+    if not EXACT_SEARCH:
+        return
+    invalidate_file_matrices(file_ids)
+    for collection_name in (TABLE_NAME, f"{TABLE_NAME}_clip"):
+        loaded = load_file_matrices(collection_name, file_ids)
+        if loaded:
+            file_matrix_cache_stats.add("warmed", len(loaded))
+
+def get_file_matrix_cache_metrics():
+    return {
+        "enabled": EXACT_SEARCH,
+        "dtype": np.dtype(FILE_MATRIX_DTYPE).name,
+        **file_matrix_cache.metrics(),
+        **file_matrix_cache_stats.snapshot()
+    }
+
+def search_clip_descriptions_batched(file_ids, probes, with_scores=False):
+    """
+    Run several CLIP probes against the image descriptions of the given files.
+    - probes: list of (text, k) pairs
+    - with_scores: return (description, similarity) pairs, similarity = 1 - best cosine distance
+    Probe texts not in the probe registry are encoded in one clip_model.encode call and every lookup runs
+    in a single statement (one LATERAL nearest-neighbour scan per probe vector).
+    Results are deduplicated in SQL and ordered by the first probe that found them.
+    With EXACT_SEARCH the probes are scored in-process against the files' cached matrices instead.
+    """
+    if not file_ids or not probes:
+        return []
+    
+    probe_vectors = encode_clip_probes([text for text, _ in probes])
+    
+    hits = None
+    if EXACT_SEARCH:
+        hits = exact_search(f"{TABLE_NAME}_clip", file_ids, probe_vectors, [probe_k for _, probe_k in probes])
+    if hits is not None:
+        # Same ordering as the SQL path: first probe that found a description, then best similarity
+        best = {}
+        for probe_index, probe_hits in enumerate(hits):
+            for _, document, similarity in probe_hits:
+                first, best_similarity = best.get(document, (probe_index, similarity))
+                best[document] = (min(first, probe_index), max(best_similarity, similarity))
+        ordered = sorted(best.items(), key=lambda item: (item[1][0], -item[1][1]))
+        if with_scores:
+            return [(document, similarity) for document, (_, similarity) in ordered]
+        return [document for document, _ in ordered]
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        collection_id = get_collection_id(cur, f"{TABLE_NAME}_clip")
+        if collection_id is None:
+            cur.close()
+            return []
+        
+        cur.execute(f"""
+            SELECT hit.document, MIN(p.ord) AS first_probe, MIN(hit.distance) AS best_distance
+            FROM unnest(%s::text[], %s::int[]) WITH ORDINALITY AS p(qvec, k, ord)
+            CROSS JOIN LATERAL (
+                SELECT e.document, e.embedding <=> p.qvec::vector AS distance
+                FROM {TABLE_NAME} e
+                WHERE e.collection_id = %s::uuid
+                  AND e.cmetadata->>'file_id' = ANY(%s)
+                ORDER BY distance
+                LIMIT p.k
+            ) AS hit
+            GROUP BY hit.document
+            ORDER BY first_probe, best_distance
+        """, (
+            [to_pgvector(vec) for vec in probe_vectors],
+            [probe_k for _, probe_k in probes],
+            collection_id,
+            list(file_ids)
+        ))
+        rows = cur.fetchall()
+        cur.close()
+        conn.commit()
+        if with_scores:
+            return [(r[0], 1 - r[2]) for r in rows]
+        return [r[0] for r in rows]
+
+# Hybrid text retrieval: full-text ranking (tsvector) fused with vector ranking by reciprocal rank fusion
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "true").lower() == "true"
+TEXT_SEARCH_CONFIG = os.environ.get("TEXT_SEARCH_CONFIG", "english")
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "20"))  # per probe, per ranking
+RRF_K = int(os.environ.get("RRF_K", "60"))
+text_search_index_ready = False
+
+def ensure_text_search_index():
+    """GIN index on the chunk text's tsvector; queries must use the same to_tsvector expression"""
+    global text_search_index_ready
+    if text_search_index_ready:
+        return True
+    try:
+        create_indexes_concurrently({
+            f"{TABLE_NAME}_document_fts_idx":
+                f"{TABLE_NAME} USING GIN (to_tsvector('{TEXT_SEARCH_CONFIG}', document))"
+        })
+        text_search_index_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring text search index: {e}")
+        return False
+
+def ensure_search_indexes():
+    """Bootstrap every index the retrieval queries rely on; failures are logged and retried next start"""
+    ensure_metadata_indexes()
+    if HYBRID_RETRIEVAL:
+        ensure_text_search_index()
+    if ANN_INDEX_AUTO_BUILD:
+        # Same entry point as POST /vector-indexes, so the two never build at once
+        run_ann_index_build()
+
+def search_text_hybrid(file_ids, probes):
+    """
+    Hybrid search over the text chunks of the given files, every probe in one statement.
+    - probes: list of (text, k) pairs
+    For each probe the HYBRID_CANDIDATES nearest chunks by embedding and the best
+    full-text matches (websearch syntax, ts_rank_cd) are ranked separately and fused
+    with RRF: score = sum of 1 / (RRF_K + rank). The top k per probe are kept and
+    merged across probes. Returns (chunk, score) pairs, best first.
+    With EXACT_SEARCH the vector ranking comes from exact_search and only the
+    full-text ranking and the fusion run in SQL.
+    """
+    if not file_ids or not probes:
+        return []
+
+    probe_vectors = [get_text_query_embedding(text) for text, _ in probes]
+    candidates = max(HYBRID_CANDIDATES, max(probe_k for _, probe_k in probes))
+    vector_hits = None
+    if EXACT_SEARCH:
+        vector_hits = exact_search(TABLE_NAME, file_ids, probe_vectors, [candidates] * len(probes))
+    if vector_hits is None:
+        vec_sql = f"""
+                SELECT p.ord, hit.id, hit.document,
+                       ROW_NUMBER() OVER (PARTITION BY p.ord ORDER BY hit.distance) AS rnk
+                FROM p
+                CROSS JOIN LATERAL (
+                    SELECT e.id, e.document, e.embedding <=> p.qvec::vector AS distance
+                    FROM {TABLE_NAME} e
+                    WHERE e.collection_id = %(collection_id)s::uuid
+                      AND e.cmetadata->>'file_id' = ANY(%(file_ids)s)
+                    ORDER BY distance
+                    LIMIT %(candidates)s
+                ) AS hit"""
+        vector_ranks = ([], [], [])
+    else:
+        vec_sql = f"""
+                SELECT v.ord, v.id, e.document, v.rnk
+                FROM unnest(%(vec_ords)s::bigint[], %(vec_ids)s::text[], %(vec_ranks)s::bigint[]) AS v(ord, id, rnk)
+                JOIN {TABLE_NAME} e ON e.id = v.id"""
+        vector_ranks = (
+            [probe_ord for probe_ord, probe_hits in enumerate(vector_hits, 1) for _ in probe_hits],
+            [row_id for probe_hits in vector_hits for row_id, _, _ in probe_hits],
+            [rank for probe_hits in vector_hits for rank in range(1, len(probe_hits) + 1)]
+        )
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        collection_id = get_collection_id(cur, TABLE_NAME)
+        if collection_id is None:
+            cur.close()
+            return []
+
+        cur.execute(f"""
+            WITH p AS (
+                SELECT * FROM unnest(%(texts)s::text[], %(vectors)s::text[], %(ks)s::int[])
+                    WITH ORDINALITY AS p(qtext, qvec, k, ord)
+            ),
+            vec AS ({vec_sql}
+            ),
+            lex AS (
+                SELECT p.ord, hit.id, hit.document,
+                       ROW_NUMBER() OVER (PARTITION BY p.ord ORDER BY hit.rank DESC) AS rnk
+                FROM p
+                CROSS JOIN LATERAL (
+                    SELECT e.id, e.document,
+                           ts_rank_cd(to_tsvector('{TEXT_SEARCH_CONFIG}', e.document), q.query) AS rank
+                    FROM {TABLE_NAME} e,
+                         websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', p.qtext) AS q(query)
+                    WHERE e.collection_id = %(collection_id)s::uuid
+                      AND e.cmetadata->>'file_id' = ANY(%(file_ids)s)
+                      AND to_tsvector('{TEXT_SEARCH_CONFIG}', e.document) @@ q.query
+                    ORDER BY rank DESC
+                    LIMIT %(candidates)s
+                ) AS hit
+            ),
+            fused AS (
+                SELECT ord, id, MIN(document) AS document, SUM(1.0 / (%(rrf_k)s + rnk)) AS score
+                FROM (SELECT * FROM vec UNION ALL SELECT * FROM lex) AS ranked
+                GROUP BY ord, id
+            ),
+            top AS (
+                SELECT fused.*, ROW_NUMBER() OVER (PARTITION BY fused.ord ORDER BY fused.score DESC) AS probe_rank
+                FROM fused
+            )
+            SELECT top.document, MAX(top.score) AS score
+            FROM top
+            JOIN p ON p.ord = top.ord
+            WHERE top.probe_rank <= p.k
+            GROUP BY top.document
+            ORDER BY score DESC
+        """, {
+            "texts": [text for text, _ in probes],
+            "vectors": [to_pgvector(vec) for vec in probe_vectors],
+            "ks": [probe_k for _, probe_k in probes],
+            "collection_id": collection_id,
+            "file_ids": list(file_ids),
+            "candidates": candidates,
+            "vec_ords": vector_ranks[0],
+            "vec_ids": vector_ranks[1],
+            "vec_ranks": vector_ranks[2],
+            "rrf_k": RRF_K
+        })
+        rows = cur.fetchall()
+        cur.close()
+        conn.commit()
+        return [(r[0], float(r[1])) for r in rows]
+
+def retrieve_by_file_ids(file_ids, query, k=8, with_scores=False):
+    """
+    Text chunks and image descriptions of the given files relevant to query.
+    With with_scores, both lists hold (content, score) pairs for ranking.
+    """
+    return retrieve_for_queries(file_ids, [query], k=k, with_scores=with_scores)
+
+def retrieve_for_queries(file_ids, queries, k=8, with_scores=False):
+    """
+    Like retrieve_by_file_ids for several queries at once: up to k text chunks per
+    query, merged, from one hybrid SQL statement, plus one batched CLIP lookup.
+    """
     store = get_vector_store()
     clip_store = get_clip_vector_store()
     
@@ -179,129 +1180,944 @@ def retrieve_by_file_ids(file_ids, query, k=8):
     filter_cond = {"file_id": file_ids}
     
     print(f"\n=== RETRIEVING CONTENT FOR FLASHCARDS/MCQs ===")
-    print(f"Query: '{query}'")
+    print(f"Queries: {queries}")
     print(f"File IDs: {file_ids}")
     
-    # Get text chunks
-    text_results = []
-    try:
-        text_docs = store.similarity_search(query, k=k, filter=filter_cond)
-        text_results = [doc.page_content for doc in text_docs]
+    # Get text chunks - full-text and vector rankings fused in one round trip
+    text_results = None
+    if HYBRID_RETRIEVAL:
+        try:
+            text_results = search_text_hybrid(file_ids, [(query, k) for query in queries])
+            print(f"Hybrid search: {len(queries)} queries -> {len(text_results)} text chunks")
+        except Exception as e:
+            print(f"Hybrid search error: {e}, falling back to vector search")
+    if text_results is None and EXACT_SEARCH:
+        try:
+            hits = exact_search(TABLE_NAME, file_ids, [get_text_query_embedding(query) for query in queries],
+                                [k] * len(queries))
+            if hits is not None:
+                scored = [[(document, similarity) for _, document, similarity in probe_hits] for probe_hits in hits]
+                text_results = sorted(merge_scored(*scored), key=lambda item: item[1], reverse=True)
+                print(f"Exact search: {len(queries)} queries -> {len(text_results)} text chunks")
+        except Exception as e:
+            print(f"Exact search error: {e}, falling back to vector search")
+    if text_results is None:
+        scored = []
+        for query in queries:
+            try:
+                query_embedding = get_text_query_embedding(query)
+                text_docs = store.similarity_search_with_score_by_vector(query_embedding, k=k, filter=filter_cond)
+                scored.append([(doc.page_content, 1 - distance) for doc, distance in text_docs])
+            except Exception as e:
+                print(f"Text search error: {e}")
+        text_results = sorted(merge_scored(*scored), key=lambda item: item[1], reverse=True)
         print(f"Found {len(text_results)} text chunks")
-    except Exception as e:
-        print(f"Text search error: {e}")
     
-    # Get image descriptions - MORE AGGRESSIVE SEARCH
+    # Get image descriptions - every probe in one CLIP encode + one SQL round trip
     image_results = []
-    
-    # Strategy 1: Try the query directly
-    try:
-        image_docs = clip_store.similarity_search(query, k=min(4, k//2), filter=filter_cond)
-        for doc in image_docs:
-            if doc.page_content not in image_results:
-                image_results.append(doc.page_content)
-        print(f"Strategy 1: Found {len(image_docs)} images with direct query")
-    except Exception as e:
-        print(f"Strategy 1 error: {e}")
-    
-    # Strategy 2: If query is specific, also try broader terms
-    if query and len(query.split()) > 2:
-        try:
-            simple_terms = query.split()[:2]  # Take first 2 words
-            for term in simple_terms:
-                docs = clip_store.similarity_search(term, k=2, filter=filter_cond)
-                for doc in docs:
-                    if doc.page_content not in image_results:
-                        image_results.append(doc.page_content)
-            print(f"Strategy 2: Found additional images with simple terms")
-        except Exception as e:
-            print(f"Strategy 2 error: {e}")
+    probes = []
+    for query in queries:
+        # Strategy 1: the query directly
+        probes.append((query, min(4, k//2)))
+        
+        # Strategy 2: If query is specific, also try broader terms
+        if query and len(query.split()) > 2:
+            for term in query.split()[:2]:  # Take first 2 words
+                probes.append((term, 2))
     
     # Strategy 3: Always search for "image" and "diagram"
+    for term in VISUAL_PROBE_TERMS:
+        probes.append((term, 2))
+    
     try:
-        visual_terms = ["image", "diagram", "chart", "graph", "figure", "photo", "picture", "illustration"]
-        for term in visual_terms:
-            docs = clip_store.similarity_search(term, k=2, filter=filter_cond)
-            for doc in docs:
-                if doc.page_content not in image_results:
-                    image_results.append(doc.page_content)
-        print(f"Strategy 3: Found images with visual terms")
+        image_results = search_clip_descriptions_batched(file_ids, probes, with_scores=True)
+        print(f"Batched CLIP search: {len(probes)} probes -> {len(image_results)} unique images")
     except Exception as e:
-        print(f"Strategy 3 error: {e}")
+        print(f"Batched CLIP search error: {e}, falling back to per-probe search")
+        seen = set()
+        for term, probe_k in probes:
+            try:
+                docs = clip_store.similarity_search_with_score(term, k=probe_k, filter=filter_cond)
+                for doc, distance in docs:
+                    if doc.page_content not in seen:
+                        seen.add(doc.page_content)
+                        image_results.append((doc.page_content, 1 - distance))
+            except Exception as probe_error:
+                print(f"Probe '{term}' error: {probe_error}")
     
-    # Strategy 4: If still no images, get ANY images from these files
-    if len(image_results) == 0:
-        try:
-            # Get random content from these files
-            all_docs = clip_store.similarity_search("a", k=5, filter=filter_cond)
-            for doc in all_docs:
-                if doc.page_content not in image_results:
-                    image_results.append(doc.page_content)
-            print(f"Strategy 4: Found {len(image_results)} images with generic search")
-        except Exception as e:
-            print(f"Strategy 4 error: {e}")
+    # Strategy 4 (any image from these files) is covered by the batch: every probe
+    # returns the nearest rows regardless of distance, so an empty result means
+    # these files have no image descriptions at all.
     
     print(f"Total image descriptions retrieved: {len(image_results)}")
     
     # Show first few descriptions
     if image_results:
         print("Sample image descriptions:")
-        for i, desc in enumerate(image_results[:3]):
-            print(f"  {i+1}. {desc[:100]}...")
+        for i, (desc, score) in enumerate(image_results[:3]):
+            print(f"  {i+1}. ({score:.3f}) {desc[:100]}...")
     
     print(f"=== RETRIEVAL COMPLETE ===\n")
     
+    if not with_scores:
+        return [text for text, _ in text_results], [desc for desc, _ in image_results]
     return text_results, image_results
 
+# ---------- Context packing ----------
+# Retrieved chunks and image descriptions are ranked by score, near-duplicates dropped,
+# and added until the endpoint's token budget is full.
+try:
+    import tiktoken
+    TIKTOKEN_SUPPORT = True
+except ImportError:
+    TIKTOKEN_SUPPORT = False
+    print("Exact token counting disabled: install tiktoken")
+
+CONTEXT_TOKEN_BUDGETS = {
+    "ask": int(os.environ.get("CONTEXT_BUDGET_ASK", "3000")),
+    "mcq": int(os.environ.get("CONTEXT_BUDGET_MCQ", "3500")),
+    "flashcards": int(os.environ.get("CONTEXT_BUDGET_FLASHCARDS", "2500")),
+    "enhance_notes": int(os.environ.get("CONTEXT_BUDGET_ENHANCE_NOTES", "4000"))
+}
+CONTEXT_IMAGE_SHARE = float(os.environ.get("CONTEXT_IMAGE_SHARE", "0.25"))  # max share of a budget for image descriptions
+CONTEXT_DEDUP_THRESHOLD = float(os.environ.get("CONTEXT_DEDUP_THRESHOLD", "0.8"))  # shingle Jaccard similarity
+CONTEXT_SHINGLE_SIZE = 5  # words per shingle
+CONTEXT_ITEM_OVERHEAD = 4  # tokens for the separator / bullet around each item
+
+token_encoding = None
+
+def count_tokens(text):
+    """Tokens in text (cl100k_base when tiktoken is available, else ~4 characters per token)"""
+    global token_encoding
+    if TIKTOKEN_SUPPORT:
+        try:
+            if token_encoding is None:
+                token_encoding = tiktoken.get_encoding("cl100k_base")
+            return len(token_encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            print(f"Token counting failed, estimating: {e}")
+    return (len(text) + 3) // 4
+
+def text_shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= CONTEXT_SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + CONTEXT_SHINGLE_SIZE]) for i in range(len(words) - CONTEXT_SHINGLE_SIZE + 1)}
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def merge_scored(*result_lists):
+    """Combine (content, score) lists from several searches, keeping each content's best score"""
+    best = {}
+    for results in result_lists:
+        for content, score in results:
+            if content not in best or score > best[content]:
+                best[content] = score
+    return list(best.items())
+
+def pack_context(text_items, image_items=(), budget_name="ask"):
+    """
+    Fit retrieved content into the token budget of an endpoint.
+    - text_items / image_items: (content, score) pairs, in any order
+    Items are taken best score first; an item too similar to one already taken is
+    dropped, and items that no longer fit are skipped. Image descriptions may use at
+    most CONTEXT_IMAGE_SHARE of the budget, text gets the rest.
+    Returns {"text", "images", "tokens", "budget", "duplicates_dropped", "over_budget_dropped"}.
+    """
+    budget = CONTEXT_TOKEN_BUDGETS[budget_name]
+    stats = {"duplicates_dropped": 0, "over_budget_dropped": 0}
+
+    def select(items, limit):
+        chosen = []
+        chosen_shingles = []
+        used = 0
+        for content, _ in sorted(merge_scored(items), key=lambda item: item[1], reverse=True):
+            if not content or not content.strip():
+                continue
+            shingles = text_shingles(content)
+            if any(jaccard(shingles, kept) >= CONTEXT_DEDUP_THRESHOLD for kept in chosen_shingles):
+                stats["duplicates_dropped"] += 1
+                continue
+            tokens = count_tokens(content) + CONTEXT_ITEM_OVERHEAD
+            if used + tokens > limit:
+                stats["over_budget_dropped"] += 1
+                continue
+            chosen.append(content)
+            chosen_shingles.append(shingles)
+            used += tokens
+        return chosen, used
+
+    images, image_tokens = select(image_items, int(budget * CONTEXT_IMAGE_SHARE))
+    text, text_tokens = select(text_items, budget - image_tokens)
+    return {
+        "text": text,
+        "images": images,
+        "tokens": text_tokens + image_tokens,
+        "budget": budget,
+        **stats
+    }
+
+def context_debug_info(packed):
+    """Packing summary reported in the endpoints' debug_info"""
+    return {
+        "context_tokens": packed["tokens"],
+        "context_token_budget": packed["budget"],
+        "token_counter": "tiktoken" if TIKTOKEN_SUPPORT else "estimate",
+        "duplicates_dropped": packed["duplicates_dropped"],
+        "over_budget_dropped": packed["over_budget_dropped"]
+    }
+
+# ---------------- LLM GATEWAY ----------------
+# Every Groq call goes through one long-lived AsyncGroq client on a background event loop:
+# HTTP connections are kept alive and reused, at most LLM_MAX_CONCURRENCY requests are in
+# flight, and 429 / 5xx / connection errors are retried with jittered backoff.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "16"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))  # seconds an idle connection is kept
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))  # seconds per request
+GROQ_RATE_LIMIT_RETRIES = int(os.environ.get("GROQ_RATE_LIMIT_RETRIES", "4"))
+GROQ_RATE_LIMIT_BACKOFF = float(os.environ.get("GROQ_RATE_LIMIT_BACKOFF", "2"))  # seconds, doubled per retry
+
+# When one call hits a 429, every call waits until this time before calling Groq again
+groq_rate_limited_until = 0.0
+groq_rate_limit_lock = threading.Lock()
+
+def note_groq_rate_limit(error, retry):
+    """Push back the shared pause after a 429, honouring Retry-After when Groq sends it"""
+    global groq_rate_limited_until
+    delay = GROQ_RATE_LIMIT_BACKOFF * (2 ** retry) * (0.5 + random.random())
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    with groq_rate_limit_lock:
+        groq_rate_limited_until = max(groq_rate_limited_until, time.time() + delay)
+    return delay
+
+def is_retryable_llm_error(error):
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+class LLMGateway:
+    """
+    Sync facade over an AsyncGroq client. The client, its connection pool and the
+    concurrency semaphore live on one event loop thread; callers in any thread block
+    on chat()/stream()/list_models() while the loop multiplexes their requests.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+        # Only updated from the loop thread
+        self.stats = {"calls": 0, "errors": 0, "retries": 0, "in_flight": 0, "total_ms": 0.0}
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return self.loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self.client = AsyncGroq(
+                    api_key=GROQ_API_KEY,
+                    max_retries=0,  # retried here instead, honouring the shared rate-limit pause
+                    timeout=LLM_TIMEOUT,
+                    http_client=httpx.AsyncClient(
+                        timeout=LLM_TIMEOUT,
+                        limits=httpx.Limits(
+                            max_connections=LLM_MAX_CONNECTIONS,
+                            max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                            keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+                        )
+                    )
+                )
+                self.semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+                ready.set()
+                loop.run_forever()
+
+            threading.Thread(target=run, name="llm-gateway", daemon=True).start()
+            ready.wait()
+            self.loop = loop
+            return loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start()).result()
+
+    async def request(self, kwargs, retries=None, consume=None):
+        """
+        One chat completion with retries. consume(response) runs while the
+        concurrency slot is still held (used to drain streams); once it has
+        started forwarding output the call is no longer retried.
+        """
+        retries = GROQ_RATE_LIMIT_RETRIES if retries is None else retries
+        for attempt in range(retries + 1):
+            pause = groq_rate_limited_until - time.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            consuming = False
+            async with self.semaphore:
+                self.stats["in_flight"] += 1
+                started = time.perf_counter()
+                try:
+                    response = await self.client.chat.completions.create(**kwargs)
+                    if consume is not None:
+                        consuming = True
+                        response = await consume(response)
+                    self.stats["calls"] += 1
+                    self.stats["total_ms"] += (time.perf_counter() - started) * 1000
+                    return response
+                except Exception as e:
+                    error = e
+                finally:
+                    self.stats["in_flight"] -= 1
+            if consuming or attempt == retries or not is_retryable_llm_error(error):
+                self.stats["errors"] += 1
+                raise error
+            self.stats["retries"] += 1
+            if isinstance(error, RateLimitError):
+                delay = note_groq_rate_limit(error, attempt)
+                print(f"  Rate limited by Groq, backing off {delay:.1f}s")
+            else:
+                delay = GROQ_RATE_LIMIT_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+                print(f"  Groq request failed ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def chat(self, messages, max_tokens, temperature, model=None, timeout=None, retries=None):
+        """Blocking chat completion; returns the Groq response object"""
+        kwargs = {
+            "model": model or GROQ_MODEL,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "timeout": timeout or LLM_TIMEOUT
+        }
+        return self.run(self.request(kwargs, retries))
+
+    def stream(self, messages, max_tokens, temperature, model=None, timeout=None):
+        """Iterate over the text deltas of a streamed completion as Groq produces them"""
+        kwargs = {
+            "model": model or GROQ_MODEL,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "timeout": timeout or LLM_TIMEOUT,
+            "stream": True
+        }
+        deltas = queue.Queue()
+        finished = object()
+
+        async def forward(stream):
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    deltas.put(chunk.choices[0].delta.content)
+
+        async def pump():
+            try:
+                await self.request(kwargs, consume=forward)
+                deltas.put(finished)
+            except Exception as e:
+                deltas.put(e)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.start())
+        try:
+            while True:
+                item = deltas.get()
+                if item is finished:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()  # the consumer went away: stop reading the stream
+
+    def list_models(self):
+        async def models():
+            async with self.semaphore:
+                return await self.client.models.list()
+        return [model.id for model in self.run(models()).data]
+
+    def close(self):
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.close(), loop).result(timeout=5)
+        except Exception as e:
+            print(f"Error closing LLM client: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+
+    def metrics(self):
+        stats = dict(self.stats)
+        return {
+            "started": self.loop is not None,
+            "max_concurrency": LLM_MAX_CONCURRENCY,
+            "max_connections": LLM_MAX_CONNECTIONS,
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "retries": stats["retries"],
+            "in_flight": stats["in_flight"],
+            "avg_latency_ms": round(stats["total_ms"] / stats["calls"], 1) if stats["calls"] else None
+        }
+
+llm_gateway = LLMGateway()
+
 # ---------------- DOCUMENT PROCESSING FUNCTIONS ----------------
 
+# ---------- LibreOffice conversion pool ----------
+LIBREOFFICE_BINARY = os.environ.get("LIBREOFFICE_BINARY", "libreoffice")
+LIBREOFFICE_WORKERS = int(os.environ.get("LIBREOFFICE_WORKERS", "2"))
+LIBREOFFICE_BASE_PORT = int(os.environ.get("LIBREOFFICE_BASE_PORT", "2002"))
+LIBREOFFICE_TIMEOUT = float(os.environ.get("LIBREOFFICE_TIMEOUT", "60"))  # per conversion
+LIBREOFFICE_QUEUE_TIMEOUT = float(os.environ.get("LIBREOFFICE_QUEUE_TIMEOUT", "120"))  # waiting for a worker
+LIBREOFFICE_STARTUP_TIMEOUT = float(os.environ.get("LIBREOFFICE_STARTUP_TIMEOUT", "30"))
+LIBREOFFICE_HEALTH_TIMEOUT = float(os.environ.get("LIBREOFFICE_HEALTH_TIMEOUT", "5"))  # liveness probe
+# unoserver runs under the distro Python that has LibreOffice's uno module and serves XML-RPC
+UNOSERVER_BINARY = os.environ.get("UNOSERVER_BINARY", "unoserver")
+
+# Import the UNO bridge (only importable where LibreOffice's Python bindings match ours)
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+    UNO_SUPPORT = True
+except ImportError:
+    UNO_SUPPORT = False
+
+# How workers talk to LibreOffice: in-process UNO, XML-RPC to a per-worker unoserver,
+# or (neither available) one short-lived soffice per conversion
+if UNO_SUPPORT:
+    LIBREOFFICE_BRIDGE = "uno"
+elif shutil.which(UNOSERVER_BINARY):
+    LIBREOFFICE_BRIDGE = "unoserver"
+else:
+    LIBREOFFICE_BRIDGE = "subprocess"
+    print("UNO bridge and unoserver not available: LibreOffice workers run one soffice per conversion")
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    """XML-RPC transport with a socket timeout, so a hung unoserver cannot block a caller forever"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+PDF_EXPORT_FILTERS = {
+    'doc': 'writer_pdf_Export', 'docx': 'writer_pdf_Export',
+    'ppt': 'impress_pdf_Export', 'pptx': 'impress_pdf_Export',
+    'xls': 'calc_pdf_Export', 'xlsx': 'calc_pdf_Export'
+}
+
+class LibreOfficeWorker:
+    """
+    One headless LibreOffice with its own user profile and temp dir, so concurrent
+    conversions never share state. With UNO or unoserver the soffice process stays
+    up between conversions, is probed before use and is restarted when it hangs;
+    with neither, each conversion runs a short-lived soffice against the same
+    already-initialised profile.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.port = LIBREOFFICE_BASE_PORT + 2 * index  # UNO socket
+        self.rpc_port = self.port + 1  # unoserver XML-RPC
+        self.profile_dir = tempfile.mkdtemp(prefix=f"lo-profile-{index}-")
+        self.work_dir = tempfile.mkdtemp(prefix=f"lo-work-{index}-")
+        self.process = None
+        self.desktop = None
+        self.conversions = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def _base_command(self):
+        return [
+            LIBREOFFICE_BINARY,
+            f"-env:UserInstallation=file://{self.profile_dir}",
+            "--headless", "--invisible", "--nologo", "--norestore", "--nodefault", "--nolockcheck"
+        ]
+
+    def _rpc(self, timeout):
+        return xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.rpc_port}", transport=TimeoutTransport(timeout), allow_none=True
+        )
+
+    def _ping_unoserver(self, timeout):
+        """True if unoserver answers over XML-RPC (it serves one call at a time, so a hung conversion blocks this)"""
+        try:
+            self._rpc(timeout).info()
+            return True
+        except xmlrpc.client.Fault:
+            return True  # an older unoserver without info() still answered
+        except (OSError, xmlrpc.client.ProtocolError):
+            return False
+
+    def _start_unoserver(self):
+        # Own session, so stop() can kill unoserver together with the soffice it spawns
+        self.process = subprocess.Popen(
+            [
+                UNOSERVER_BINARY,
+                "--interface", "127.0.0.1", "--port", str(self.rpc_port),
+                "--uno-interface", "127.0.0.1", "--uno-port", str(self.port),
+                "--executable", shutil.which(LIBREOFFICE_BINARY) or LIBREOFFICE_BINARY,
+                "--user-installation", self.profile_dir
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        deadline = time.time() + LIBREOFFICE_STARTUP_TIMEOUT
+        while not self._ping_unoserver(LIBREOFFICE_HEALTH_TIMEOUT):
+            if time.time() > deadline or self.process.poll() is not None:
+                self.stop()
+                raise RuntimeError(f"LibreOffice worker {self.index} did not start")
+            time.sleep(0.25)
+
+    def start(self):
+        if LIBREOFFICE_BRIDGE == "unoserver":
+            self._start_unoserver()
+            return
+        if LIBREOFFICE_BRIDGE == "subprocess":
+            # Create the user profile now; it is what makes a cold soffice start slow
+            subprocess.run(
+                self._base_command() + ["--terminate_after_init"],
+                capture_output=True, timeout=LIBREOFFICE_STARTUP_TIMEOUT
+            )
+            return
+        self.process = subprocess.Popen(
+            self._base_command() + [
+                f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        deadline = time.time() + LIBREOFFICE_STARTUP_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+                )
+                break
+            except NoConnectException:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError(f"LibreOffice worker {self.index} did not start")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+
+    def stop(self):
+        self.desktop = None
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait(timeout=5)
+            except Exception:
+                pass
+            self.process = None
+
+    def restart(self):
+        print(f"Restarting LibreOffice worker {self.index}")
+        self.restarts += 1
+        self.stop()
+        self.start()
+
+    def is_healthy(self):
+        if LIBREOFFICE_BRIDGE == "subprocess":
+            return True
+        if self.process is None or self.process.poll() is not None:
+            return False
+        if LIBREOFFICE_BRIDGE == "unoserver":
+            return self._ping_unoserver(LIBREOFFICE_HEALTH_TIMEOUT)
+        if self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def _convert_with_uno(self, input_path, output_path, export_filter):
+        def prop(name, value):
+            p = PropertyValue()
+            p.Name = name
+            p.Value = value
+            return p
+
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(input_path), "_blank", 0, (prop("Hidden", True),)
+        )
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(output_path), (prop("FilterName", export_filter),))
+        finally:
+            document.close(True)
+
+    def convert(self, input_path, extension, timeout):
+        """Convert input_path to PDF and return the PDF bytes; raises on failure or timeout"""
+        stem = os.path.splitext(os.path.basename(input_path))[0]
+        output_path = os.path.join(self.work_dir, f"{stem}.pdf")
+        try:
+            if LIBREOFFICE_BRIDGE == "unoserver":
+                try:
+                    # Positional: inpath, indata, outpath, convert_to, filtername
+                    self._rpc(timeout).convert(
+                        input_path, None, output_path, "pdf", PDF_EXPORT_FILTERS.get(extension, 'writer_pdf_Export')
+                    )
+                except (TimeoutError, OSError) as e:
+                    # No answer in time: soffice is hung (or gone), so replace it
+                    self.failures += 1
+                    self.restart()
+                    if isinstance(e, TimeoutError):
+                        raise TimeoutError("Conversion timeout - LibreOffice took too long")
+                    raise RuntimeError(f"Conversion failed: {e}")
+                except (xmlrpc.client.Fault, xmlrpc.client.ProtocolError) as e:
+                    self.failures += 1
+                    raise RuntimeError(f"Conversion failed: {e}")
+            elif LIBREOFFICE_BRIDGE == "uno":
+                # A UNO call cannot be interrupted, so run it aside and kill soffice if it hangs
+                outcome = {}
+
+                def run():
+                    try:
+                        self._convert_with_uno(
+                            input_path, output_path, PDF_EXPORT_FILTERS.get(extension, 'writer_pdf_Export')
+                        )
+                    except Exception as e:
+                        outcome["error"] = e
+
+                runner = threading.Thread(target=run, daemon=True)
+                runner.start()
+                runner.join(timeout)
+                if runner.is_alive():
+                    self.failures += 1
+                    self.restart()
+                    raise TimeoutError("Conversion timeout - LibreOffice took too long")
+                if "error" in outcome:
+                    self.failures += 1
+                    raise RuntimeError(f"Conversion failed: {outcome['error']}")
+            else:
+                result = subprocess.run(
+                    self._base_command() + ["--convert-to", "pdf", "--outdir", self.work_dir, input_path],
+                    capture_output=True, text=True, timeout=timeout
+                )
+                if result.returncode != 0:
+                    self.failures += 1
+                    raise RuntimeError(f"Conversion failed: {result.stderr}")
+
+            if not os.path.exists(output_path):
+                self.failures += 1
+                raise RuntimeError("Conversion failed: LibreOffice produced no PDF")
+            with open(output_path, 'rb') as pdf_file:
+                pdf_data = pdf_file.read()
+            self.conversions += 1
+            return pdf_data
+        except subprocess.TimeoutExpired:
+            self.failures += 1
+            raise TimeoutError("Conversion timeout - LibreOffice took too long")
+        finally:
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+
+
+class LibreOfficePool:
+    """Conversions queue for a free worker; unhealthy workers are restarted before use"""
+
+    def __init__(self, size):
+        self.workers = [LibreOfficeWorker(i) for i in range(size)]
+        self._idle = queue.Queue()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._waiting_lock = threading.Lock()
+        self._waiting = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for worker in self.workers:
+                try:
+                    worker.start()
+                except Exception as e:
+                    # Worker is restarted by the health check on first use
+                    print(f"LibreOffice worker {worker.index} failed to start: {e}")
+                self._idle.put(worker)
+            self._started = True
+            print(f"LibreOffice pool ready: {len(self.workers)} workers (bridge: {LIBREOFFICE_BRIDGE})")
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def convert(self, input_path, extension, timeout=None, queue_timeout=None):
+        self.start()
+        with self._waiting_lock:
+            self._waiting += 1
+        try:
+            worker = self._idle.get(timeout=queue_timeout or LIBREOFFICE_QUEUE_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError("Conversion timeout - no LibreOffice worker became free")
+        finally:
+            with self._waiting_lock:
+                self._waiting -= 1
+        try:
+            if not worker.is_healthy():
+                worker.restart()
+            return worker.convert(input_path, extension, timeout or LIBREOFFICE_TIMEOUT)
+        finally:
+            self._idle.put(worker)
+
+    def metrics(self):
+        with self._waiting_lock:
+            waiting = self._waiting
+        return {
+            "workers": len(self.workers),
+            "uno": UNO_SUPPORT,
+            "bridge": LIBREOFFICE_BRIDGE,
+            "started": self._started,
+            "idle": self._idle.qsize(),
+            "waiting": waiting,
+            "conversions": sum(w.conversions for w in self.workers),
+            "failures": sum(w.failures for w in self.workers),
+            "restarts": sum(w.restarts for w in self.workers)
+        }
+
+libreoffice_pool = LibreOfficePool(LIBREOFFICE_WORKERS)
+
 def convert_office_to_pdf(file_stream, filename):
-    """Convert Office files to PDF using local LibreOffice"""
+    """Convert Office files to PDF on the LibreOffice worker pool"""
+    extension = filename.lower().split('.')[-1] if '.' in filename else 'tmp'
+    temp_input_path = None
     try:
-        # Save uploaded file to temp location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.tmp') as temp_input:
+        # Save uploaded file to temp location (keep the extension so LibreOffice picks the right filter)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{extension}') as temp_input:
             file_stream.seek(0)
             temp_input.write(file_stream.read())
             temp_input_path = temp_input.name
         
-        # Convert using LibreOffice
-        cmd = [
-            'libreoffice', '--headless', '--convert-to', 'pdf', 
-            '--outdir', '/tmp', temp_input_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode == 0:
-            # Find the converted PDF
-            pdf_path = temp_input_path.replace('.tmp', '.pdf')
-            if os.path.exists(pdf_path):
-                with open(pdf_path, 'rb') as pdf_file:
-                    pdf_data = pdf_file.read()
-                
-                # Cleanup temporary files
-                os.unlink(temp_input_path)
-                os.unlink(pdf_path)
-                
-                return pdf_data, None
-        
-        return None, f"Conversion failed: {result.stderr}"
+        pdf_data = libreoffice_pool.convert(temp_input_path, extension)
+        return pdf_data, None
         
-    except subprocess.TimeoutExpired:
-        return None, "Conversion timeout - LibreOffice took too long"
+    except TimeoutError as e:
+        return None, str(e)
+    except RuntimeError as e:
+        return None, str(e)
     except Exception as e:
         return None, f"Conversion error: {str(e)}"
+    finally:
+        if temp_input_path and os.path.exists(temp_input_path):
+            os.unlink(temp_input_path)
+
+# "pymupdf" (single pass, default) or "pdfplumber" (slower, better layout fidelity for text)
+PDF_TEXT_ENGINE = os.environ.get("PDF_TEXT_ENGINE", "pymupdf").lower()
+
+PIXMAP_MODES = pdf_workers.PIXMAP_MODES
+
+# Opt-in: shard large PDFs' page ranges across worker processes
+PDF_PARALLEL_EXTRACTION = os.environ.get("PDF_PARALLEL_EXTRACTION", "false").lower() == "true"
+PDF_PARALLEL_WORKERS = int(os.environ.get("PDF_PARALLEL_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_PARALLEL_PAGES_PER_SHARD = int(os.environ.get("PDF_PARALLEL_PAGES_PER_SHARD", "16"))
+
+pdf_process_pool = None
+pdf_process_pool_lock = threading.Lock()
+
+def get_pdf_process_pool():
+    """
+    Worker processes are spawned (not forked) so they start clean of the model
+    threads and DB sockets of this process, and only import pdf_workers.
+    """
+    global pdf_process_pool
+    with pdf_process_pool_lock:
+        if pdf_process_pool is None:
+            pdf_process_pool = ProcessPoolExecutor(
+                max_workers=PDF_PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return pdf_process_pool
+
+def shut_down_pdf_process_pool():
+    global pdf_process_pool
+    with pdf_process_pool_lock:
+        if pdf_process_pool is not None:
+            pdf_process_pool.shutdown(wait=False, cancel_futures=True)
+            pdf_process_pool = None
+
+def use_parallel_extraction(page_count, parallel=None):
+    enabled = PDF_PARALLEL_EXTRACTION if parallel is None else parallel
+    return enabled and PDF_PARALLEL_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES
+
+def pixmap_to_image(pix):
+    """Wrap a PyMuPDF pixmap's samples as a PIL image without a PNG round trip"""
+    mode = PIXMAP_MODES.get((pix.n - pix.alpha, pix.alpha))
+    if mode is None:
+        return None
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+def iter_pdf_pages(doc, pdf_data=None, engine=None):
+    """
+    Yield an open PyMuPDF document one page at a time as
+    {"page", "text", "images", "width", "height", "image_xrefs"}.
+    Only the current page's images are held; each xref is extracted once.
+    Closes the document when exhausted or when the consumer stops early.
+    """
+    engine = (engine or PDF_TEXT_ENGINE).lower()
+    seen_xrefs = set()
+    plumber = None
+    try:
+        if engine == "pdfplumber" and pdf_data is not None:
+            plumber = pdfplumber.open(io.BytesIO(pdf_data))
+        print(f"  Extracting {len(doc)} PDF pages with {engine}...")
+
+        for page_num, page in enumerate(doc):
+            started = time.perf_counter()
+            try:
+                if plumber is not None:
+                    page_text = plumber.pages[page_num].extract_text() or ""
+                    plumber.pages[page_num].flush_cache()
+                else:
+                    page_text = page.get_text("text")
+            except Exception as text_error:
+                print(f"    Failed to extract text on page {page_num + 1}: {text_error}")
+                page_text = ""
+
+            images = []
+            xrefs = [img[0] for img in page.get_images()]
+            for xref in xrefs:
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                try:
+                    pix = fitz.Pixmap(doc, xref)
+                    img_pil = pixmap_to_image(pix)
+                    if img_pil is not None:  # RGB or similar
+                        images.append(img_pil)
+                    pix = None  # Free memory
+                except Exception as img_error:
+                    print(f"    Failed to extract image xref {xref} on page {page_num + 1}: {img_error}")
+
+            yield {
+                "page": page_num + 1,
+                "text": page_text,
+                "images": images,
+                "width": round(page.rect.width, 1),
+                "height": round(page.rect.height, 1),
+                "image_xrefs": xrefs,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+            }
+    finally:
+        if plumber is not None:
+            plumber.close()
+        doc.close()
+
+def iter_pdf_pages_parallel(pdf_data, page_count, engine=None):
+    """
+    Same pages as iter_pdf_pages, extracted by the process pool in shards of
+    PDF_PARALLEL_PAGES_PER_SHARD pages. Shards are yielded in page order and at
+    most two per worker are in flight, so a slow consumer holds back extraction.
+    """
+    engine = (engine or PDF_TEXT_ENGINE).lower()
+    pool = get_pdf_process_pool()
+    shards = [
+        (start, min(start + PDF_PARALLEL_PAGES_PER_SHARD, page_count))
+        for start in range(0, page_count, PDF_PARALLEL_PAGES_PER_SHARD)
+    ]
+    max_in_flight = PDF_PARALLEL_WORKERS * 2
+    seen_xrefs = set()
+    pending = []
+    next_shard = 0
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_pdf:
+        temp_pdf.write(pdf_data)
+        temp_path = temp_pdf.name
+    print(f"  Extracting {page_count} PDF pages with {engine} across {PDF_PARALLEL_WORKERS} processes ({len(shards)} shards)...")
+    try:
+        while next_shard < len(shards) or pending:
+            while next_shard < len(shards) and len(pending) < max_in_flight:
+                start, end = shards[next_shard]
+                pending.append(pool.submit(pdf_workers.extract_page_range, temp_path, start, end, engine))
+                next_shard += 1
+            for page in pending.pop(0).result():
+                images = []
+                for xref, mode, size, samples in page["images"]:
+                    # xrefs are document-wide, so images shared across shards are kept once
+                    if xref in seen_xrefs:
+                        continue
+                    seen_xrefs.add(xref)
+                    images.append(Image.frombytes(mode, size, samples))
+                page["images"] = images
+                yield page
+    finally:
+        for future in pending:
+            future.cancel()
+        os.unlink(temp_path)
+
+def extract_pdf_content(pdf_data, engine=None, parallel=None):
+    """
+    Open a PDF once with PyMuPDF and collect, page by page:
+    - the page text (from PyMuPDF, or pdfplumber when engine == "pdfplumber")
+    - the embedded images (PIL.Image), each xref extracted only once
+    - page metadata (number, size, text length, image xrefs, extraction time)
+    Large PDFs go through the process pool when parallel extraction is enabled.
+    Returns (text, images, pages).
+    """
+    page_texts = []
+    images = []
+    pages = []
+    try:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+        page_count = len(doc)
+        if use_parallel_extraction(page_count, parallel):
+            doc.close()
+            page_iter = iter_pdf_pages_parallel(pdf_data, page_count, engine)
+        else:
+            page_iter = iter_pdf_pages(doc, pdf_data, engine)
+        for page in page_iter:
+            if page["text"].strip():
+                page_texts.append(page["text"].strip())
+            images.extend(page["images"])
+            pages.append({
+                "page": page["page"],
+                "width": page["width"],
+                "height": page["height"],
+                "text_chars": len(page["text"]),
+                "image_xrefs": page["image_xrefs"],
+                "elapsed_ms": page["elapsed_ms"]
+            })
+    except Exception as e:
+        print(f"Error extracting PDF content: {e}")
+
+    print(f"  Extracted {sum(p['text_chars'] for p in pages)} chars and {len(images)} images from {len(pages)} pages")
+    return "\n".join(page_texts), images, pages
 
 def extract_text_from_pdf(file_stream):
-    """Extract text from PDF file"""
-    text = ""
+    """Extract text from PDF file with pdfplumber"""
+    page_texts = []
     try:
         with pdfplumber.open(file_stream) as pdf:
             for page in pdf.pages:
                 page_text = page.extract_text()
                 if page_text:
-                    text += page_text + "\n"
-        return text.strip()
+                    page_texts.append(page_text)
+        return "\n".join(page_texts).strip()
     except Exception as e:
         print(f"Error extracting PDF text: {e}")
         return ""
@@ -456,30 +2272,142 @@ def extract_text_from_xlsx(file_stream):
         
         return text.strip()
     except Exception as e:
-        print(f"Error extracting XLSX text: {e}")
-        return ""
+        print(f"Error extracting XLSX text: {e}")
+        return ""
+
+# ---------- Image descriptions ----------
+IMAGE_DESCRIPTION_CONCURRENCY = int(os.environ.get("IMAGE_DESCRIPTION_CONCURRENCY", "4"))
+
+# Descriptions keyed by a hash of the normalized image: in-process LRU in front of Postgres
+IMAGE_DESCRIPTION_CACHE_SIZE = int(os.environ.get("IMAGE_DESCRIPTION_CACHE_SIZE", "2048"))
+image_description_cache = LRUCache(max_entries=IMAGE_DESCRIPTION_CACHE_SIZE)
+image_description_cache_stats = Counters(db_hits=0, misses=0, stored=0, duplicates_in_upload=0)
+image_description_cache_table_ready = False
+
+def ensure_image_description_cache_table():
+    global image_description_cache_table_ready
+    if image_description_cache_table_ready:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS image_description_cache (
+                    image_hash CHAR(64) NOT NULL,
+                    model TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    hits INT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_hit_at TIMESTAMP,
+                    PRIMARY KEY (image_hash, model)
+                )
+            """)
+            conn.commit()
+            cur.close()
+        image_description_cache_table_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring image_description_cache table: {e}")
+        return False
+
+def normalize_image(image):
+    """Flatten any image mode onto an RGB canvas"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Convert to RGB for PDF compatibility
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'RGBA':
+            background.paste(image, mask=image.split()[-1])
+        else:
+            background.paste(image)
+        return background
+    if image.mode != 'RGB':
+        return image.convert("RGB")
+    return image
+
+def hash_image(image):
+    """Content hash of the normalized pixels, so re-encoded copies of an image share a key"""
+    image = normalize_image(image)
+    digest = hashlib.sha256(f"{image.size[0]}x{image.size[1]}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def get_cached_image_description(image_hash):
+    cache_key = (image_hash, GROQ_MODEL)
+    description = image_description_cache.get(cache_key)
+    if description is not None:
+        return description
+    if not ensure_image_description_cache_table():
+        image_description_cache_stats.add("misses")
+        return None
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE image_description_cache
+                SET hits = hits + 1, last_hit_at = %s
+                WHERE image_hash = %s AND model = %s
+                RETURNING description
+            """, (datetime.now(), image_hash, GROQ_MODEL))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"  Image description cache lookup failed: {e}")
+        image_description_cache_stats.add("misses")
+        return None
+    if row is None:
+        image_description_cache_stats.add("misses")
+        return None
+    image_description_cache_stats.add("db_hits")
+    image_description_cache.put(cache_key, row[0])
+    return row[0]
+
+def store_image_description(image_hash, description):
+    image_description_cache.put((image_hash, GROQ_MODEL), description)
+    if not ensure_image_description_cache_table():
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO image_description_cache (image_hash, model, description)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (image_hash, model) DO UPDATE SET description = EXCLUDED.description
+            """, (image_hash, GROQ_MODEL, description))
+            conn.commit()
+            cur.close()
+        image_description_cache_stats.add("stored")
+    except Exception as e:
+        print(f"  Failed to cache image description: {e}")
+
+def get_image_description_cache_metrics():
+    memory = image_description_cache.metrics()
+    stats = image_description_cache_stats.snapshot()
+    lookups = memory["hits"] + stats["db_hits"] + stats["misses"]
+    hits = memory["hits"] + stats["db_hits"]
+    return {
+        "memory_hits": memory["hits"],
+        "db_hits": stats["db_hits"],
+        "misses": stats["misses"],
+        "hit_rate": round(hits / lookups, 3) if lookups else None,
+        "stored": stats["stored"],
+        "duplicates_in_upload": stats["duplicates_in_upload"],
+        "memory_entries": memory["entries"]
+    }
 
-def generate_image_description(image):
+def generate_image_description(image, image_hash=None):
     """Generate text description of image using Groq for CLIP indexing"""
-    client = Groq(api_key=GROQ_API_KEY)
-    
     try:
+        image = normalize_image(image)
+        image_hash = image_hash or hash_image(image)
+        cached = get_cached_image_description(image_hash)
+        if cached is not None:
+            print(f"  Image description cache hit ({image_hash[:12]})")
+            return cached
+        
         # Convert image to PNG bytes
         img_byte_arr = io.BytesIO()
-        
-        # Handle different image modes
-        if image.mode in ('RGBA', 'LA', 'P'):
-            # Convert to RGB for PDF compatibility
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'RGBA':
-                background.paste(image, mask=image.split()[-1])
-            else:
-                background.paste(image)
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert("RGB")
-        
-        image.save(img_byte_arr, format='PNG', optimize=True)
+        image.save(img_byte_arr, format='PNG')
         img_b64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
         
         print(f"  Generating description for image ({image.size[0]}x{image.size[1]}, mode: {image.mode})...")
@@ -493,13 +2421,12 @@ def generate_image_description(image):
         
         for attempt, prompt in enumerate(prompts):
             try:
-                response = client.chat.completions.create(
-                    model=GROQ_MODEL,
+                response = llm_gateway.chat(
                     messages=[{
                         "role": "user",
                         "content": [
                             {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
+                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_b64}"}}
                         ]
                     }],
                     max_tokens=300,  # Increased for better descriptions
@@ -511,6 +2438,7 @@ def generate_image_description(image):
                 
                 if description and len(description) > 20:  # Valid description
                     print(f"  Generated description ({len(description)} chars): {description[:100]}...")
+                    store_image_description(image_hash, description)
                     return description
                 else:
                     print(f"  Attempt {attempt+1}: Description too short: '{description}'")
@@ -526,7 +2454,54 @@ def generate_image_description(image):
     except Exception as e:
         print(f"  Error generating image description: {e}")
         return f"Image content (error: {str(e)[:50]})"
-    
+
+class StreamingImageDescriber:
+    """
+    Describe a document's images as pages produce them, at most
+    IMAGE_DESCRIPTION_CONCURRENCY Groq calls in flight. submit() blocks while
+    max_pending images are waiting, so extraction cannot run ahead of the
+    describer and pile up decoded images. finish() returns descriptions in
+    submission order.
+    - on_progress(done, total) is called as descriptions complete
+    """
+    def __init__(self, max_pending=None, on_progress=None):
+        self.on_progress = on_progress
+        self.pool = ThreadPoolExecutor(max_workers=IMAGE_DESCRIPTION_CONCURRENCY, thread_name_prefix="describe")
+        self.slots = threading.BoundedSemaphore(max_pending or IMAGE_DESCRIPTION_CONCURRENCY * 2)
+        self.futures = OrderedDict()  # image_hash -> future, repeated images are described once
+        self.order = []  # image_hash per submitted image
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def submit(self, image):
+        image_hash = hash_image(image)
+        self.order.append(image_hash)
+        if image_hash in self.futures:
+            image_description_cache_stats.add("duplicates_in_upload")
+            self.futures[image_hash].add_done_callback(self._completed)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(generate_image_description, image, image_hash)
+        future.add_done_callback(lambda _: self.slots.release())
+        future.add_done_callback(self._completed)
+        self.futures[image_hash] = future
+
+    def _completed(self, future):
+        with self.lock:
+            self.done += 1
+            done = self.done
+        if self.on_progress:
+            self.on_progress(done, len(self.order))
+
+    def finish(self):
+        try:
+            return [self.futures[image_hash].result() for image_hash in self.order]
+        finally:
+            self.close()
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
 def convert_image_or_text_to_pdf(file_stream, filename):
     """
     Converts image or text files to PDF.
@@ -608,19 +2583,59 @@ def convert_image_or_text_to_pdf(file_stream, filename):
     return None, f"Unsupported file type for conversion to PDF: {ext}"
 
 
-def process_file_content(file, filename):
+def single_page_document(text, error, images, pdf_data):
+    return {
+        "pdf_data": pdf_data,
+        "error": error,
+        "page_count": 1,
+        "has_images": bool(images),
+        "pages": iter([{"page": 1, "text": text or "", "images": images}])
+    }
+
+def failed_document(error):
+    return {"pdf_data": None, "error": error, "page_count": 0, "has_images": False, "pages": None}
+
+def pdf_document(pdf_data):
+    doc = None
+    try:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+        if doc.needs_pass:
+            raise ValueError("document is password protected")
+        # Listing image xrefs reads the page resources only, nothing is decoded
+        has_images = any(page.get_images() for page in doc)
+        page_count = len(doc)
+    except Exception as e:
+        # Corrupt or encrypted PDFs are reported like any other extraction failure
+        if doc is not None:
+            doc.close()
+        return failed_document(f"PDF open failed: {e}")
+    parallel = use_parallel_extraction(page_count)
+    if parallel:
+        doc.close()
+        pages = iter_pdf_pages_parallel(pdf_data, page_count)
+    else:
+        pages = iter_pdf_pages(doc, pdf_data)
+    return {
+        "pdf_data": pdf_data,
+        "error": None,
+        "page_count": page_count,
+        "has_images": has_images,
+        "parallel": parallel,
+        "pages": pages
+    }
+
+def open_document(file_bytes, filename):
     """
-    Process uploaded file and return:
-    - text content
-    - error message if any
-    - list of images (PIL.Image)
-    - PDF bytes (if converted or original PDF)
+    Prepare an uploaded file for page-by-page processing. Returns a dict with:
+    - pdf_data: PDF bytes (if converted or original PDF)
+    - error: error message if any
+    - page_count / has_images: known up front, before any page is extracted
+    - pages: iterator of page dicts ({"page", "text", "images"}), None on failure
     """
     file_extension = filename.lower().split('.')[-1] if '.' in filename else ''
-    file_bytes = file.read()
     file_stream = io.BytesIO(file_bytes)
     
-    print(f"\n📄 PROCESSING FILE: {filename}, Type: {file_extension}")
+    print(f"Opening {filename}, Type: {file_extension}")
     
     # ---------- Office files (convert to PDF first) ----------
     office_types = ['docx', 'pptx', 'xlsx', 'doc', 'ppt', 'xls']
@@ -635,63 +2650,33 @@ def process_file_content(file, filename):
                 if file_extension == 'docx' and DOCX_SUPPORT:
                     text = extract_text_from_docx(file_stream)
                     print(f"Fallback: Extracted {len(text)} chars from DOCX")
-                    return text, f"Fallback text only. {error}", [], None
+                    return single_page_document(text, f"Fallback text only. {error}", [], None)
                 elif file_extension == 'pptx' and PPTX_SUPPORT:
                     text = extract_text_from_pptx(file_stream)
                     print(f"Fallback: Extracted {len(text)} chars from PPTX")
-                    return text, f"Fallback text only. {error}", [], None
+                    return single_page_document(text, f"Fallback text only. {error}", [], None)
                 elif file_extension == 'xlsx' and XLSX_SUPPORT:
                     text = extract_text_from_xlsx(file_stream)
                     print(f"Fallback: Extracted {len(text)} chars from XLSX")
-                    return text, f"Fallback text only. {error}", [], None
+                    return single_page_document(text, f"Fallback text only. {error}", [], None)
                 else:
-                    return None, f"No extraction fallback available. {error}", [], None
+                    return failed_document(f"No extraction fallback available. {error}")
             except Exception as e:
                 print(f"Fallback extraction failed: {e}")
-                return None, f"Fallback extraction failed: {e}", [], None
+                return failed_document(f"Fallback extraction failed: {e}")
 
-        # Success: extract text and images from PDF
+        # Success: stream text and images from the PDF
         print(f"Successfully converted to PDF ({len(pdf_data)} bytes)")
-        pdf_stream = io.BytesIO(pdf_data)
-        
-        # Extract text
-        pdf_stream.seek(0)
-        text = extract_text_from_pdf(pdf_stream)
-        print(f"Extracted {len(text)} chars of text")
-        
-        # Extract images
-        pdf_stream.seek(0)
-        images = extract_images_from_pdf(pdf_stream)
-        print(f"🖼️ Extracted {len(images)} images")
-        
-        # Debug: Show image info
-        for i, img in enumerate(images):
-            print(f"  Image {i+1}: {img.size} pixels, mode: {img.mode}")
-        
-        return text, None, images, pdf_data
+        return pdf_document(pdf_data)
 
     # ---------- PDF files ----------
     elif file_extension == 'pdf':
         if not PDF_SUPPORT:
-            return None, "PDF support not available. Install pdfplumber.", [], None
+            return failed_document("PDF support not available. Install pdfplumber.")
         
         print(f"📄 Processing PDF file directly...")
         
-        # Extract text
-        pdf_stream = io.BytesIO(file_bytes)
-        text = extract_text_from_pdf(pdf_stream)
-        print(f"Extracted {len(text)} chars of text")
-        
-        # Extract images
-        pdf_stream.seek(0)
-        images = extract_images_from_pdf(pdf_stream)
-        print(f"🖼️ Extracted {len(images)} images")
-        
-        # Debug: Show image info
-        for i, img in enumerate(images):
-            print(f"  Image {i+1}: {img.size} pixels, mode: {img.mode}")
-        
-        return text, None, images, file_bytes
+        return pdf_document(file_bytes)
 
     # ---------- IMAGE files (JPG, PNG, GIF, etc.) ----------
     elif file_extension in ['png', 'jpg', 'jpeg', 'bmp', 'gif', 'webp', 'tiff']:
@@ -741,7 +2726,7 @@ def process_file_content(file, filename):
                     images = [image]
                     print(f"  Loaded with alternative method")
                 except:
-                    return None, f"Failed to process image: {img_error}", [], None
+                    return failed_document(f"Failed to process image: {img_error}")
             
             # Convert to PDF for storage
             file_stream.seek(0)
@@ -749,14 +2734,14 @@ def process_file_content(file, filename):
             if error:
                 print(f"  PDF conversion failed: {error}")
                 # Still return the images even if PDF conversion fails
-                return "", error, images, None
+                return single_page_document("", error, images, None)
             
             print(f"  Successfully generated PDF ({len(pdf_data)} bytes)")
-            return "", None, images, pdf_data
+            return single_page_document("", None, images, pdf_data)
             
         except Exception as e:
             print(f"Error processing image file {filename}: {e}")
-            return None, f"Image processing failed: {e}", [], None
+            return failed_document(f"Image processing failed: {e}")
 
     # ---------- TEXT files ----------
     elif file_extension == 'txt':
@@ -771,14 +2756,14 @@ def process_file_content(file, filename):
             pdf_data, error = convert_image_or_text_to_pdf(file_stream, filename)
             if error:
                 print(f"  PDF conversion failed: {error}")
-                return text, error, [], None
+                return single_page_document(text, error, [], None)
             
             print(f"  Successfully generated PDF ({len(pdf_data)} bytes)")
-            return text, None, [], pdf_data
+            return single_page_document(text, None, [], pdf_data)
             
         except Exception as e:
             print(f"Error processing text file {filename}: {e}")
-            return None, f"Text processing failed: {e}", [], None
+            return failed_document(f"Text processing failed: {e}")
 
     # ---------- Plain text fallback ----------
     else:
@@ -786,16 +2771,37 @@ def process_file_content(file, filename):
         try:
             text = file_bytes.decode("utf-8", errors="ignore")
             print(f"Processed as plain text: {len(text)} chars")
-            return text, None, [], None
+            return single_page_document(text, None, [], None)
         except Exception as e:
             print(f"Unsupported file type: {file_extension}. {e}")
-            return None, f"Unsupported file type: {file_extension}. {e}", [], None
-        
+            return failed_document(f"Unsupported file type: {file_extension}. {e}")
+
+def process_file_content(file, filename):
+    """
+    Process uploaded file and return:
+    - text content
+    - error message if any
+    - list of images (PIL.Image)
+    - PDF bytes (if converted or original PDF)
+    Collects every page in memory; ingestion streams open_document() instead.
+    """
+    print(f"\n📄 PROCESSING FILE: {filename}")
+    document = open_document(file.read(), filename)
+    if document["pages"] is None:
+        return None, document["error"], [], None
+    
+    page_texts = []
+    images = []
+    for page in document["pages"]:
+        if page["text"].strip():
+            page_texts.append(page["text"].strip())
+        images.extend(page["images"])
+    print(f"Extracted {sum(len(t) for t in page_texts)} chars of text and {len(images)} images")
+    return "\n".join(page_texts), document["error"], images, document["pdf_data"]
+
 # ---------- LLM (Groq API call) ----------
 
 def groq_chat(context: str, question: str, images: list = None) -> str:
-    client = Groq(api_key=GROQ_API_KEY)
-    
     messages = [
         {
             "role": "system", 
@@ -822,8 +2828,7 @@ def groq_chat(context: str, question: str, images: list = None) -> str:
     messages.append({"role": "user", "content": user_content})
     
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=messages,
             max_tokens=2048,
             temperature=0.1
@@ -842,33 +2847,25 @@ def groq_chat(context: str, question: str, images: list = None) -> str:
 # Chat History Functions
 def save_chat_history(file_id, question, answer):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        with db_connection() as conn:
+            cur = conn.cursor()
 
-        cur.execute(
-            "INSERT INTO chat_history (file_id, question, answer, timestamp) VALUES (%s, %s, %s, %s)",
-            (file_id, question, answer, datetime.now())
-        )
+            cur.execute(
+                "INSERT INTO chat_history (file_id, question, answer, timestamp) VALUES (%s, %s, %s, %s)",
+                (file_id, question, answer, datetime.now())
+            )
 
-        conn.commit()
-        cur.close()
-        conn.close()
+            conn.commit()
+            cur.close()
         return True
     
     except Exception as e:
         print(f"Error saving chat history: {e}")
-        try:
-            conn.rollback()
-        except:
-            pass
         return False
 
 
 def get_chat_history(file_ids, limit=10):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         placeholders = ",".join(["%s"] * len(file_ids))
         query = f"""
             SELECT file_id, question, answer, timestamp 
@@ -878,11 +2875,11 @@ def get_chat_history(file_ids, limit=10):
             LIMIT %s
         """
 
-        cur.execute(query, file_ids + [limit])
-        rows = cur.fetchall()
-
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, file_ids + [limit])
+            rows = cur.fetchall()
+            cur.close()
 
         return [{
             "file_id": r[0],
@@ -895,27 +2892,162 @@ def get_chat_history(file_ids, limit=10):
         print(f"Error getting chat history: {e}")
         return []
 
+# Answer Cache Functions
+# /ask answers keyed by the file_id set and the question's MiniLM embedding;
+# a new question within ANSWER_CACHE_THRESHOLD cosine similarity reuses the answer.
+# Only questions asked without prior chat history are cached or served from it.
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.93"))
+answer_cache_stats = Counters(hits=0, misses=0, stored=0, invalidated=0, latency_saved_ms=0.0)
+answer_cache_table_ready = False
+
+def ensure_answer_cache_table():
+    global answer_cache_table_ready
+    if answer_cache_table_ready:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    id SERIAL PRIMARY KEY,
+                    file_ids_key TEXT NOT NULL,
+                    file_ids TEXT[] NOT NULL,
+                    model TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    embedding vector({EMBED_DIM}) NOT NULL,
+                    answer TEXT NOT NULL,
+                    generation_ms REAL,
+                    hits INT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_hit_at TIMESTAMP
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS answer_cache_file_ids_key_idx ON answer_cache (file_ids_key)")
+            cur.execute("CREATE INDEX IF NOT EXISTS answer_cache_file_ids_idx ON answer_cache USING GIN (file_ids)")
+            conn.commit()
+            cur.close()
+        answer_cache_table_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring answer_cache table: {e}")
+        return False
+
+def answer_cache_key(file_ids):
+    return ",".join(sorted(set(file_ids)))
+
+def find_cached_answer(file_ids, question_embedding):
+    """Closest earlier answer for exactly this file_id set, if similar enough; else None"""
+    if not ANSWER_CACHE_ENABLED or not ensure_answer_cache_table():
+        return None
+    try:
+        vector = to_pgvector(question_embedding)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, question, answer, generation_ms, 1 - (embedding <=> %s::vector) AS similarity
+                FROM answer_cache
+                WHERE file_ids_key = %s AND model = %s
+                ORDER BY embedding <=> %s::vector
+                LIMIT 1
+            """, (vector, answer_cache_key(file_ids), GROQ_MODEL, vector))
+            row = cur.fetchone()
+            if row is not None and row[4] >= ANSWER_CACHE_THRESHOLD:
+                cur.execute(
+                    "UPDATE answer_cache SET hits = hits + 1, last_hit_at = %s WHERE id = %s",
+                    (datetime.now(), row[0])
+                )
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Answer cache lookup failed: {e}")
+        answer_cache_stats.add("misses")
+        return None
+    if row is None or row[4] < ANSWER_CACHE_THRESHOLD:
+        answer_cache_stats.add("misses")
+        return None
+    answer_cache_stats.add("hits")
+    return {
+        "question": row[1],
+        "answer": row[2],
+        "generation_ms": row[3] or 0.0,
+        "similarity": round(float(row[4]), 4)
+    }
+
+def store_cached_answer(file_ids, question, question_embedding, answer, generation_ms):
+    if not ANSWER_CACHE_ENABLED or not answer or not ensure_answer_cache_table():
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO answer_cache (file_ids_key, file_ids, model, question, embedding, answer, generation_ms)
+                VALUES (%s, %s, %s, %s, %s::vector, %s, %s)
+            """, (
+                answer_cache_key(file_ids), sorted(set(file_ids)), GROQ_MODEL,
+                question, to_pgvector(question_embedding), answer, generation_ms
+            ))
+            conn.commit()
+            cur.close()
+        answer_cache_stats.add("stored")
+    except Exception as e:
+        print(f"Failed to cache answer: {e}")
+
+def invalidate_answer_cache(file_ids):
+    """Drop cached answers that used any of these files (re-uploaded or deleted)"""
+    if not file_ids or not ensure_answer_cache_table():
+        return 0
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM answer_cache WHERE file_ids && %s::text[]", (list(file_ids),))
+            deleted = cur.rowcount
+            conn.commit()
+            cur.close()
+        answer_cache_stats.add("invalidated", deleted)
+        return deleted
+    except Exception as e:
+        print(f"Failed to invalidate answer cache: {e}")
+        return 0
+
+def get_answer_cache_metrics():
+    stats = answer_cache_stats.snapshot()
+    lookups = stats["hits"] + stats["misses"]
+    return {
+        "enabled": ANSWER_CACHE_ENABLED,
+        "threshold": ANSWER_CACHE_THRESHOLD,
+        **stats,
+        "latency_saved_ms": round(stats["latency_saved_ms"], 1),
+        "hit_rate": round(stats["hits"] / lookups, 3) if lookups else None
+    }
+
+
+recap_cards_table_ready = False
 
 def ensure_recap_cards_table():
+    global recap_cards_table_ready
+    if recap_cards_table_ready:
+        return True
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS recap_cards_progress (
-                id SERIAL PRIMARY KEY,
-                file_id VARCHAR(255) NOT NULL,
-                level INT NOT NULL CHECK (level IN (1, 2, 3)),
-                completed BOOLEAN DEFAULT FALSE,
-                completed_at TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(file_id, level)
-            )
-        """)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS recap_cards_progress (
+                    id SERIAL PRIMARY KEY,
+                    file_id VARCHAR(255) NOT NULL,
+                    level INT NOT NULL CHECK (level IN (1, 2, 3)),
+                    completed BOOLEAN DEFAULT FALSE,
+                    completed_at TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(file_id, level)
+                )
+            """)
+            
+            conn.commit()
+            cur.close()
+        recap_cards_table_ready = True
         return True
     except Exception as e:
         print(f"Error ensuring recap_cards_progress table: {e}")
@@ -929,18 +3061,17 @@ def mark_level_completed(file_id: str, level: int):
     try:
         ensure_recap_cards_table()
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            INSERT INTO recap_cards_progress (file_id, level, completed, completed_at)
-            VALUES (%s, %s, TRUE, %s)
-            ON CONFLICT (file_id, level) DO UPDATE SET completed = TRUE, completed_at = %s
-        """, (file_id, level, datetime.now(), datetime.now()))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                INSERT INTO recap_cards_progress (file_id, level, completed, completed_at)
+                VALUES (%s, %s, TRUE, %s)
+                ON CONFLICT (file_id, level) DO UPDATE SET completed = TRUE, completed_at = %s
+            """, (file_id, level, datetime.now(), datetime.now()))
+            
+            conn.commit()
+            cur.close()
         return True
     except Exception as e:
         print(f"Error marking level completed: {e}")
@@ -950,18 +3081,17 @@ def mark_level_completed(file_id: str, level: int):
 def get_completed_levels(file_id: str) -> list:
     ensure_recap_cards_table()
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT level FROM recap_cards_progress 
-            WHERE file_id = %s AND completed = TRUE
-            ORDER BY level
-        """, (file_id,))
-        
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                SELECT level FROM recap_cards_progress 
+                WHERE file_id = %s AND completed = TRUE
+                ORDER BY level
+            """, (file_id,))
+            
+            rows = cur.fetchall()
+            cur.close()
         
         return [r[0] for r in rows]
     except Exception as e:
@@ -986,8 +3116,6 @@ def get_next_available_level(file_id: str) -> int:
 
 
 def groq_chat_with_history(context: str, question: str, chat_history: list, images: list = None) -> str:
-    client = Groq(api_key=GROQ_API_KEY)
-    
     # Build messages with explicit conversation structure
     messages = [
         {
@@ -1020,8 +3148,7 @@ def groq_chat_with_history(context: str, question: str, chat_history: list, imag
     messages.append({"role": "user", "content": user_content})
     
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=messages,
             max_tokens=2048,
             temperature=0.1
@@ -1036,8 +3163,6 @@ def groq_chat_with_history(context: str, question: str, chat_history: list, imag
         return error_msg
     
 def generate_mcq_with_groq(context: str, num_questions: int = 5):
-    client = Groq(api_key=GROQ_API_KEY)
-    
     prompt = f"""
     CONTENT:
     {context}
@@ -1070,8 +3195,7 @@ def generate_mcq_with_groq(context: str, num_questions: int = 5):
     """
     
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=[
                 {
                     "role": "system",
@@ -1118,22 +3242,9 @@ def generate_mcq_with_groq(context: str, num_questions: int = 5):
         print(f"Groq API error: {e}")
         return [{"error": f"MCQ generation failed: {str(e)}"}]
 
-def get_db_connection():
-    return db.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        sslmode="require"
-    )
-
-    
 #-----------Flashcard Generation with Groq-----------
 def generate_flashcards_with_groq(context: str, num_flashcards: int = 5, level: int = 1, fill_gaps: bool = False):
     """Generate flashcards at different difficulty levels"""
-    client = Groq(api_key=GROQ_API_KEY)
-    
     # Level-specific prompts
     level_prompts = {
         1: f"""
@@ -1238,8 +3349,7 @@ def generate_flashcards_with_groq(context: str, num_flashcards: int = 5, level:
         prompt += "\n\nADDITIONAL: Also identify and fill knowledge gaps in the notes."
     
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=[
                 {
                     "role": "system",
@@ -1287,8 +3397,6 @@ def generate_flashcards_with_groq(context: str, num_flashcards: int = 5, level:
     
 def generate_missing_notes(context: str):
     """Generate additional notes to fill knowledge gaps"""
-    client = Groq(api_key=GROQ_API_KEY)
-    
     prompt = f"""
     STUDENT'S CURRENT NOTES:
     {context}
@@ -1330,8 +3438,7 @@ def generate_missing_notes(context: str):
     """
     
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=[
                 {
                     "role": "system",
@@ -1351,21 +3458,804 @@ def generate_missing_notes(context: str):
         return result
         
     except Exception as e:
-        print(f"Groq API error in notes generation: {e}")
-        return {
-            "missing_notes": [],
-            "study_advice": "Could not generate additional notes. Please try again."
+        print(f"Groq API error in notes generation: {e}")
+        return {
+            "missing_notes": [],
+            "study_advice": "Could not generate additional notes. Please try again."
+        }
+# ---------------- INGESTION JOBS ----------------
+# Uploads are queued as jobs and processed by a small worker pool, so the
+# request returns right away and the event loop never runs extraction work.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+INGESTION_STAGES = ["extraction", "storage", "embedding", "indexing"]
+# Pages are streamed through extraction -> splitting -> embedding/describing;
+# these bound how much of a document is held in memory at once.
+PIPELINE_PREFETCH_PAGES = int(os.environ.get("PIPELINE_PREFETCH_PAGES", "2"))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+SPLITTER_BUFFER_CHARS = int(os.environ.get("SPLITTER_BUFFER_CHARS", "20000"))
+
+ingestion_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+ingestion_jobs = {}  # job_id -> live state of jobs queued or running in this process
+ingestion_jobs_lock = threading.Lock()
+ingestion_jobs_table_ready = False
+
+def ensure_ingestion_jobs_table():
+    global ingestion_jobs_table_ready
+    if ingestion_jobs_table_ready:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                    id UUID PRIMARY KEY,
+                    file_id VARCHAR(255) NOT NULL,
+                    file_name TEXT NOT NULL,
+                    content_type TEXT,
+                    module_id TEXT,
+                    ocr BOOLEAN DEFAULT FALSE,
+                    s3_key TEXT,
+                    s3_url TEXT,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    stages JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    result JSONB,
+                    error TEXT,
+                    attempts INT NOT NULL DEFAULT 0,
+                    payload BYTEA,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS ingestion_jobs_status_idx ON ingestion_jobs (status)")
+            conn.commit()
+            cur.close()
+        ingestion_jobs_table_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring ingestion_jobs table: {e}")
+        return False
+
+def new_stage_states():
+    return {
+        stage: {"status": "pending", "progress": None, "started_at": None, "duration_ms": None, "detail": None}
+        for stage in INGESTION_STAGES
+    }
+
+def create_ingestion_job(filename, content, content_type, module_id, ocr):
+    """Persist a queued job (including the uploaded bytes) and return its public fields"""
+    ensure_ingestion_jobs_table()
+    job_id = str(uuid.uuid4())
+    file_id = str(uuid.uuid4())
+    timestamp = int(time.time() * 1000)
+    pdf_filename = filename.rsplit('.', 1)[0] + '.pdf'
+    s3_key = (
+        f"modules/{module_id}/{timestamp}-{pdf_filename}"
+        if module_id
+        else f"uploads/{file_id}-{pdf_filename}"
+    )
+    s3_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
+    stages = new_stage_states()
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO ingestion_jobs
+                (id, file_id, file_name, content_type, module_id, ocr, s3_key, s3_url, status, stages, payload)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'queued', %s::jsonb, %s)
+        """, (job_id, file_id, filename, content_type, module_id, ocr, s3_key, s3_url,
+              json.dumps(stages), db.Binary(content)))
+        conn.commit()
+        cur.close()
+
+    with ingestion_jobs_lock:
+        ingestion_jobs[job_id] = {"status": "queued", "stages": stages}
+
+    return {
+        "job_id": job_id,
+        "file_id": file_id,
+        "file_name": filename,
+        "s3_key": s3_key,
+        "s3_url": s3_url
+    }
+
+def update_ingestion_job(job_id, **columns):
+    """Write job columns back to Postgres; stages/result are stored as JSONB"""
+    assignments = []
+    values = []
+    for column, value in columns.items():
+        if column in ("stages", "result"):
+            assignments.append(f"{column} = %s::jsonb")
+            values.append(json.dumps(value) if value is not None else None)
+        else:
+            assignments.append(f"{column} = %s")
+            values.append(value)
+    assignments.append("updated_at = %s")
+    values.append(datetime.now())
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"UPDATE ingestion_jobs SET {', '.join(assignments)} WHERE id = %s", values + [job_id])
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Error updating ingestion job {job_id}: {e}")
+
+def snapshot_stages(job_id):
+    with ingestion_jobs_lock:
+        return json.loads(json.dumps(ingestion_jobs[job_id]["stages"]))
+
+def start_stage(job_id, stage, total=None):
+    with ingestion_jobs_lock:
+        state = ingestion_jobs[job_id]["stages"][stage]
+        state["status"] = "running"
+        state["started_at"] = time.time()
+        state["progress"] = {"done": 0, "total": total} if total else None
+    update_ingestion_job(job_id, stages=snapshot_stages(job_id))
+
+def advance_stage(job_id, stage, done, total=None):
+    """In-memory progress update; /jobs/{id} reads it live without a DB write per item"""
+    with ingestion_jobs_lock:
+        state = ingestion_jobs[job_id]["stages"][stage]
+        progress = state["progress"] or {"done": 0, "total": total}
+        progress["done"] = done
+        if total is not None:
+            progress["total"] = total
+        state["progress"] = progress
+
+def finish_stage(job_id, stage, status="done", detail=None):
+    with ingestion_jobs_lock:
+        state = ingestion_jobs[job_id]["stages"][stage]
+        if state["started_at"]:
+            state["duration_ms"] = round((time.time() - state["started_at"]) * 1000, 1)
+        state["status"] = status
+        state["detail"] = detail
+    update_ingestion_job(job_id, stages=snapshot_stages(job_id))
+
+def load_ingestion_job(job_id, with_payload=False):
+    columns = [
+        "id", "file_id", "file_name", "content_type", "module_id", "ocr", "s3_key", "s3_url",
+        "status", "stages", "result", "error", "attempts", "created_at", "started_at", "finished_at"
+    ]
+    if with_payload:
+        columns.append("payload")
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(columns)} FROM ingestion_jobs WHERE id = %s", (job_id,))
+        row = cur.fetchone()
+        cur.close()
+    if row is None:
+        return None
+    job = dict(zip(columns, row))
+    job["id"] = str(job["id"])
+    if with_payload and job["payload"] is not None:
+        job["payload"] = bytes(job["payload"])
+    return job
+
+def submit_ingestion_job(job_id):
+    ingestion_executor.submit(run_ingestion_job, job_id)
+
+def run_ingestion_job(job_id):
+    """Worker entry point: run every stage of one job and record the outcome"""
+    try:
+        job = load_ingestion_job(job_id, with_payload=True)
+    except Exception as e:
+        print(f"Could not load ingestion job {job_id}: {e}")
+        return
+    if job is None or job["status"] not in ("queued", "running") or job["payload"] is None:
+        return
+
+    with ingestion_jobs_lock:
+        stages = ingestion_jobs.get(job_id, {}).get("stages") or new_stage_states()
+        # A resumed job starts its stages over
+        if job["attempts"] > 0:
+            stages = new_stage_states()
+        ingestion_jobs[job_id] = {"status": "running", "stages": stages}
+
+    update_ingestion_job(
+        job_id,
+        status="running",
+        attempts=job["attempts"] + 1,
+        started_at=datetime.now(),
+        stages=snapshot_stages(job_id)
+    )
+    print(f"\n=== INGESTION JOB {job_id}: {job['file_name']} (attempt {job['attempts'] + 1}) ===")
+
+    try:
+        if job["attempts"] > 0:
+            # Remove whatever a previous interrupted attempt managed to index
+            delete_file_vectors([job["file_id"]])
+        result = ingest_file(job, job["payload"])
+        update_ingestion_job(
+            job_id,
+            status="completed",
+            result=result,
+            stages=snapshot_stages(job_id),
+            finished_at=datetime.now(),
+            payload=None
+        )
+        print(f"=== INGESTION JOB {job_id} COMPLETED ===\n")
+        try:
+            warm_file_matrices([job["file_id"]])
+        except Exception as e:
+            # The file is loaded on first access instead
+            print(f"Failed to warm embedding matrices for {job['file_id']}: {e}")
+    except Exception as e:
+        print(f"Ingestion job {job_id} failed: {e}")
+        with ingestion_jobs_lock:
+            for state in ingestion_jobs[job_id]["stages"].values():
+                if state["status"] == "running":
+                    state["status"] = "failed"
+        update_ingestion_job(
+            job_id,
+            status="failed",
+            error=str(e),
+            stages=snapshot_stages(job_id),
+            finished_at=datetime.now(),
+            payload=None
+        )
+    finally:
+        # Finished jobs are served from Postgres
+        with ingestion_jobs_lock:
+            ingestion_jobs.pop(job_id, None)
+
+def resume_ingestion_jobs():
+    """Re-queue jobs that were queued or running when the process stopped"""
+    if not ensure_ingestion_jobs_table():
+        return 0
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id FROM ingestion_jobs
+            WHERE status IN ('queued', 'running') AND payload IS NOT NULL
+            ORDER BY created_at
+        """)
+        job_ids = [str(r[0]) for r in cur.fetchall()]
+        cur.close()
+    for job_id in job_ids:
+        with ingestion_jobs_lock:
+            ingestion_jobs[job_id] = {"status": "queued", "stages": new_stage_states()}
+        submit_ingestion_job(job_id)
+    if job_ids:
+        print(f"Resumed {len(job_ids)} ingestion jobs")
+    return len(job_ids)
+
+def delete_file_vectors(file_ids):
+    """Delete text and CLIP rows stored for the given file_ids"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM {TABLE_NAME} WHERE cmetadata->>'file_id' = ANY(%s)", (list(file_ids),))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    invalidate_file_matrices(file_ids)
+    return deleted
+
+# Content-addressed ingest cache: identical uploads reuse the first upload's vectors and PDF
+ingest_cache_table_ready = False
+
+def ensure_ingest_cache_table():
+    global ingest_cache_table_ready
+    if ingest_cache_table_ready:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ingest_cache (
+                    content_hash CHAR(64) NOT NULL,
+                    ocr BOOLEAN NOT NULL,
+                    file_id VARCHAR(255) NOT NULL,
+                    file_name TEXT,
+                    s3_key TEXT NOT NULL,
+                    chunks INT NOT NULL DEFAULT 0,
+                    images INT NOT NULL DEFAULT 0,
+                    text_extracted INT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (content_hash, ocr)
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS ingest_cache_file_id_idx ON ingest_cache (file_id)")
+            conn.commit()
+            cur.close()
+        ingest_cache_table_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring ingest_cache table: {e}")
+        return False
+
+def find_ingest_cache_entry(content_hash, ocr):
+    if not ensure_ingest_cache_table():
+        return None
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT file_id, file_name, s3_key, chunks, images, text_extracted
+                FROM ingest_cache
+                WHERE content_hash = %s AND ocr = %s
+            """, (content_hash, ocr))
+            row = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        print(f"Ingest cache lookup failed: {e}")
+        return None
+    if row is None:
+        return None
+    return dict(zip(["file_id", "file_name", "s3_key", "chunks", "images", "text_extracted"], row))
+
+def record_ingest_cache_entry(content_hash, ocr, file_id, filename, s3_key, chunks, images, text_extracted):
+    if not ensure_ingest_cache_table():
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO ingest_cache (content_hash, ocr, file_id, file_name, s3_key, chunks, images, text_extracted)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (content_hash, ocr) DO NOTHING
+            """, (content_hash, ocr, file_id, filename, s3_key, chunks, images, text_extracted))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Failed to record ingest cache entry: {e}")
+
+def forget_ingest_cache_entries(file_ids):
+    """Drop cache entries whose source vectors were deleted"""
+    if not ensure_ingest_cache_table():
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM ingest_cache WHERE file_id = ANY(%s)", (list(file_ids),))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Failed to clear ingest cache entries: {e}")
+
+def clone_file_vectors(source_file_id, file_id, filename):
+    """Copy every text and CLIP row of source_file_id under a new file_id in one statement"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            INSERT INTO {TABLE_NAME} (id, collection_id, embedding, document, cmetadata)
+            SELECT gen_random_uuid()::text, collection_id, embedding, document,
+                   cmetadata || jsonb_build_object('file_id', %s::text, 'file_name', %s::text)
+            FROM {TABLE_NAME}
+            WHERE cmetadata->>'file_id' = %s
+        """, (file_id, filename, source_file_id))
+        cloned = cur.rowcount
+        conn.commit()
+        cur.close()
+    return cloned
+
+def ingest_duplicate_file(job, entry):
+    """
+    Serve an upload whose bytes were ingested before: server-side S3 copy of the stored
+    PDF plus a row clone of its vectors. Returns None when the cached source is gone.
+    """
+    job_id = job["id"]
+    filename = job["file_name"]
+    file_id = job["file_id"]
+    print(f"Duplicate upload of file {entry['file_id']}, cloning instead of re-ingesting")
+
+    finish_stage(job_id, "extraction", status="skipped", detail={"deduplicated_from": entry["file_id"]})
+
+    start_stage(job_id, "storage")
+    try:
+        # The Node backend deletes S3 objects with their file, so each upload gets its own copy
+        s3.copy_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=job["s3_key"],
+            CopySource={"Bucket": S3_BUCKET_NAME, "Key": entry["s3_key"]}
+        )
+    except Exception as e:
+        print(f"S3 copy from cached upload failed ({e}), ingesting from scratch")
+        forget_ingest_cache_entries([entry["file_id"]])
+        finish_stage(job_id, "storage", status="pending")
+        return None
+    finish_stage(job_id, "storage", detail={"copied_from": entry["s3_key"]})
+
+    start_stage(job_id, "embedding")
+    cloned = clone_file_vectors(entry["file_id"], file_id, filename)
+    if cloned == 0 and entry["chunks"] + entry["images"] > 0:
+        print("Cached upload has no vectors left, ingesting from scratch")
+        forget_ingest_cache_entries([entry["file_id"]])
+        finish_stage(job_id, "embedding", status="pending")
+        return None
+    finish_stage(job_id, "embedding", detail={"rows_cloned": cloned})
+    finish_stage(job_id, "indexing", status="skipped", detail={"deduplicated_from": entry["file_id"]})
+
+    return {
+        "file_name": filename,
+        "file_id": file_id,
+        "chunks": entry["chunks"],
+        "images_processed": entry["images"],
+        "file_type": (
+            filename.lower().split('.')[-1]
+            if '.' in filename else 'unknown'
+        ),
+        "s3_key": job["s3_key"],
+        "s3_url": job["s3_url"],
+        "html": None,
+        "error": None,
+        "debug_info": {
+            "text_extracted": entry["text_extracted"],
+            "images_found": entry["images"],
+            "images_stored_in_clip": entry["images"],
+            "deduplicated_from": entry["file_id"]
+        }
+    }
+
+def prefetch(iterable, maxsize=PIPELINE_PREFETCH_PAGES):
+    """
+    Run a generator on a background thread, at most maxsize items ahead of the
+    consumer. The producer blocks when the queue is full (backpressure) and
+    stops when the consumer does; producer exceptions re-raise in the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+    sentinel = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+        except BaseException as e:
+            put((sentinel, e))
+            return
+        finally:
+            if stop.is_set() and hasattr(iterable, "close"):
+                iterable.close()
+        put((sentinel, None))
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is sentinel:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join(timeout=5)
+
+class StreamingTextSplitter:
+    """
+    Split text as it arrives. Text is buffered until buffer_chars, then every
+    chunk but the last is emitted; the last one is carried over so chunks never
+    end at an arbitrary buffer boundary and keep their overlap.
+    """
+    def __init__(self, chunk_size=1000, chunk_overlap=200, buffer_chars=SPLITTER_BUFFER_CHARS):
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.buffer_chars = max(buffer_chars, chunk_size * 2)
+        self.buffer = ""
+
+    def feed(self, text):
+        if not text or not text.strip():
+            return []
+        self.buffer = f"{self.buffer}\n{text.strip()}" if self.buffer else text.strip()
+        if len(self.buffer) < self.buffer_chars:
+            return []
+        chunks = self.splitter.split_text(self.buffer)
+        if len(chunks) < 2:
+            return []
+        self.buffer = chunks[-1]
+        return chunks[:-1]
+
+    def flush(self):
+        chunks = self.splitter.split_text(self.buffer) if self.buffer.strip() else []
+        self.buffer = ""
+        return chunks
+
+def ingest_file(job, content):
+    """
+    Extract, store, embed and index one uploaded file; returns the upload result entry.
+    Pages stream through the pipeline: text goes to the splitter and is embedded in
+    EMBED_BATCH_SIZE batches, images go to the describer as soon as they are decoded.
+    """
+    job_id = job["id"]
+    filename = job["file_name"]
+    file_id = job["file_id"]
+    ocr = job["ocr"]
+    s3_key = job["s3_key"]
+    s3_url = job["s3_url"]
+    file_type = filename.lower().split('.')[-1] if '.' in filename else 'unknown'
+    errors = []
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    entry = find_ingest_cache_entry(content_hash, ocr)
+    if entry is not None:
+        result = ingest_duplicate_file(job, entry)
+        if result is not None:
+            return result
+
+    # ---- extraction: open the document, pages are read lazily below ----
+    start_stage(job_id, "extraction")
+    document = open_document(content, filename)
+    error = document["error"]
+    pdf_data = document["pdf_data"]
+    page_count = document["page_count"]
+    has_images = document["has_images"]
+    print(f"Opened {filename}: {page_count} pages, images: {has_images}, Error: {error}")
+
+    # OCR PROCESSING
+    ocr_text = ""
+    if ocr and document["pages"] is not None:
+        print("OCR flag enabled, extracting text with Groq...")
+        try:
+            ocr_stream = io.BytesIO(content)
+            ocr_text = extract_text_with_groq_ocr(ocr_stream, filename)
+            print(f"OCR extracted {len(ocr_text)} characters")
+        except Exception as e:
+            print(f"OCR failed: {e}")
+            ocr_text = f"OCR failed: {str(e)}"
+    use_ocr_text = bool(ocr_text) and len(ocr_text) > 10 and not ocr_text.startswith("OCR failed")
+    if use_ocr_text:
+        print("Using OCR text for vector storage")
+
+    # ---- storage ----
+    start_stage(job_id, "storage")
+    try:
+        if pdf_data:
+            s3.put_object(
+                Bucket=S3_BUCKET_NAME,
+                Key=s3_key,
+                Body=pdf_data,
+                ContentType='application/pdf'
+            )
+            print(f"Uploaded PDF to S3: {s3_key}")
+        else:
+            s3.put_object(
+                Bucket=S3_BUCKET_NAME,
+                Key=s3_key,
+                Body=content,
+                ContentType=job["content_type"] or "application/octet-stream"
+            )
+        finish_stage(job_id, "storage")
+    except Exception as e:
+        print(f"S3 upload failed: {e}")
+        errors.append(f"S3 upload failed: {e}")
+        s3_key = None
+        s3_url = None
+        finish_stage(job_id, "storage", status="failed", detail=str(e))
+
+    # ---- embedding + indexing, fed page by page ----
+    chunks_stored = 0
+    embedding_failed = None
+    text_chars = 0
+    images_found = 0
+    page_timings_ms = []  # extraction time per page, in page order
+    splitter = StreamingTextSplitter(chunk_size=1000, chunk_overlap=200)
+    describer = None
+
+    def embed_chunks(chunks):
+        nonlocal chunks_stored, embedding_failed
+        if embedding_failed or not chunks:
+            return
+        for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+            batch = chunks[start:start + EMBED_BATCH_SIZE]
+            metadatas = [{
+                "file_id": file_id,
+                "file_name": filename,
+                "chunk_index": chunks_stored + i,
+                "file_type": file_type,
+                "content_type": "text",
+                "has_images": has_images,
+                "ocr_processed": ocr
+            } for i in range(len(batch))]
+            try:
+                get_vector_store().add_texts(
+                    texts=batch,
+                    metadatas=metadatas,
+                    ids=[str(uuid.uuid4()) for _ in batch]
+                )
+                chunks_stored += len(batch)
+                advance_stage(job_id, "embedding", chunks_stored)
+            except Exception as e:
+                print(f"Failed to store text chunks: {e}")
+                embedding_failed = str(e)
+                errors.append(f"Failed to store text chunks: {e}")
+                return
+
+    start_stage(job_id, "embedding")
+
+    try:
+        if document["pages"] is not None:
+            for page in prefetch(document["pages"]):
+                if not use_ocr_text:
+                    text_chars += len(page["text"])
+                    embed_chunks(splitter.feed(page["text"]))
+                for image in page["images"]:
+                    images_found += 1
+                    if describer is None:
+                        start_stage(job_id, "indexing")
+                        describer = StreamingImageDescriber(
+                            on_progress=lambda done, total: advance_stage(job_id, "indexing", done, total)
+                        )
+                        print(f"Describing images for CLIP storage as pages stream in ({IMAGE_DESCRIPTION_CONCURRENCY} at a time)...")
+                    describer.submit(image)
+                page["images"] = None
+                if page.get("elapsed_ms") is not None:
+                    page_timings_ms.append(page["elapsed_ms"])
+                advance_stage(job_id, "extraction", page["page"], page_count)
+        if use_ocr_text:
+            text_chars = len(ocr_text)
+            embed_chunks(splitter.feed(ocr_text))
+        embed_chunks(splitter.flush())
+        finish_stage(job_id, "extraction", detail={
+            "pages": page_count,
+            "parallel": document.get("parallel", False),
+            "text_chars": text_chars,
+            "images_found": images_found,
+            "page_timings_ms": page_timings_ms,
+            "error": error
+        })
+    except Exception as e:
+        print(f"Extraction failed mid-document: {e}")
+        errors.append(f"Extraction failed: {e}")
+        finish_stage(job_id, "extraction", status="failed", detail=str(e))
+
+    if embedding_failed:
+        finish_stage(job_id, "embedding", status="failed", detail=embedding_failed)
+    elif chunks_stored:
+        print(f"Stored {chunks_stored} text chunks in vector DB")
+        finish_stage(job_id, "embedding", detail={"chunks": chunks_stored})
+    else:
+        finish_stage(job_id, "embedding", status="skipped")
+
+    # ---- indexing: image descriptions into the CLIP vector store ----
+    images_stored = 0
+    if describer is not None and images_found:
+        descriptions = describer.finish()
+        metadatas = [{
+            "file_id": file_id,
+            "file_name": filename,
+            "image_index": img_index,
+            "file_type": "image",
+            "content_type": "image",
+            "original_content": description[:500]
+        } for img_index, description in enumerate(descriptions)]
+
+        try:
+            get_clip_vector_store().add_texts(
+                texts=descriptions,
+                metadatas=metadatas,
+                ids=[str(uuid.uuid4()) for _ in descriptions]
+            )
+            images_stored = len(descriptions)
+        except Exception as e:
+            print(f"  Failed to store image descriptions: {e}")
+            errors.append(f"Failed to store image descriptions: {e}")
+        print(f"Total images stored in CLIP: {images_stored}/{images_found}")
+        finish_stage(job_id, "indexing", detail={"images_stored": images_stored})
+    else:
+        if describer is not None:
+            describer.close()
+        print("No images found to store in CLIP")
+        finish_stage(job_id, "indexing", status="skipped")
+
+    if errors:
+        error = "; ".join(([error] if error else []) + errors)
+    elif error is None and s3_key:
+        record_ingest_cache_entry(
+            content_hash, ocr, file_id, filename, s3_key,
+            chunks_stored, images_stored, text_chars
+        )
+
+    return {
+        "file_name": filename,
+        "file_id": file_id,
+        "chunks": chunks_stored,
+        "images_processed": images_found,
+        "file_type": file_type,
+        "s3_key": s3_key,
+        "s3_url": s3_url,
+        "html": None,
+        "error": error,
+        "debug_info": {
+            "text_extracted": text_chars,
+            "images_found": images_found,
+            "images_stored_in_clip": images_stored,
+            "pages": page_count
         }
+    }
+
+def get_ingestion_metrics():
+    with ingestion_jobs_lock:
+        statuses = [job["status"] for job in ingestion_jobs.values()]
+    return {
+        "workers": INGEST_WORKERS,
+        "queued": statuses.count("queued"),
+        "running": statuses.count("running")
+    }
+
+def describe_ingestion_job(job_id):
+    """Public view of a job: live state for active jobs, Postgres for the rest"""
+    job = load_ingestion_job(job_id)
+    if job is None:
+        return None
+    with ingestion_jobs_lock:
+        live = ingestion_jobs.get(job_id)
+        if live is not None:
+            job["stages"] = json.loads(json.dumps(live["stages"]))
+    stages = []
+    for stage in INGESTION_STAGES:
+        state = dict((job["stages"] or {}).get(stage) or {"status": "pending"})
+        if state.get("status") == "running" and state.get("started_at"):
+            state["elapsed_ms"] = round((time.time() - state["started_at"]) * 1000, 1)
+        state.pop("started_at", None)
+        stages.append({"name": stage, **state})
+    duration_ms = None
+    if job["started_at"] and job["finished_at"]:
+        duration_ms = round((job["finished_at"] - job["started_at"]).total_seconds() * 1000, 1)
+    return {
+        "job_id": job["id"],
+        "file_id": job["file_id"],
+        "file_name": job["file_name"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "stages": stages,
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"].isoformat() if job["created_at"] else None,
+        "started_at": job["started_at"].isoformat() if job["started_at"] else None,
+        "finished_at": job["finished_at"].isoformat() if job["finished_at"] else None,
+        "duration_ms": duration_ms
+    }
+
 # ------------------- ENDPOINTS --------------------------------------------------------
 
+@app.on_event("startup")
+def warm_up():
+    """Do one-off setup work here so the first requests don't pay for it"""
+    try:
+        warm_probe_embeddings()
+    except Exception as e:
+        # Probe embeddings fall back to lazy caching on first use
+        print(f"Failed to warm probe embeddings: {e}")
+    try:
+        prewarm_vector_stores()
+    except Exception as e:
+        # Stores are still created lazily on first use
+        print(f"Failed to prewarm vector stores: {e}")
+    try:
+        libreoffice_pool.start()
+    except Exception as e:
+        print(f"Failed to start LibreOffice pool: {e}")
+    try:
+        resume_ingestion_jobs()
+    except Exception as e:
+        print(f"Failed to resume ingestion jobs: {e}")
+    # Queries work without the indexes, just slower, so they are built in the background
+    threading.Thread(target=ensure_search_indexes, name="index-bootstrap", daemon=True).start()
+
+@app.on_event("shutdown")
+def shut_down():
+    libreoffice_pool.stop()
+    shut_down_pdf_process_pool()
+    llm_gateway.close()
+
 @app.get("/")
 def health():
     try:
         init_recap_cards_table()
         
-        client = Groq(api_key=GROQ_API_KEY)
-        models = client.models.list()
-        model_names = [model.id for model in models.data]
+        model_names = llm_gateway.list_models()
 
         return {
             "status": "ok",
@@ -1377,7 +4267,9 @@ def health():
                 "pptx": PPTX_SUPPORT,
                 "xlsx": XLSX_SUPPORT,
                 "pdf": PDF_SUPPORT,
-                "libreoffice": True
+                "libreoffice": True,
+                "libreoffice_uno": UNO_SUPPORT,
+                "libreoffice_bridge": LIBREOFFICE_BRIDGE
             },
             "available_models": model_names
         }
@@ -1387,6 +4279,48 @@ def health():
             status_code=200
         )
 
+@app.get("/status")
+def status():
+    """Runtime metrics for the service's shared resources"""
+    return {
+        "db_pool": db_pool.metrics(),
+        "vector_engine": get_vector_engine_metrics(),
+        "ingestion": get_ingestion_metrics(),
+        "image_description_cache": get_image_description_cache_metrics(),
+        "answer_cache": get_answer_cache_metrics(),
+        "file_matrix_cache": get_file_matrix_cache_metrics(),
+        "llm": llm_gateway.metrics(),
+        "ocr": get_ocr_metrics(),
+        "libreoffice": libreoffice_pool.metrics()
+    }
+
+@app.get("/vector-indexes")
+def get_vector_indexes():
+    """ANN indexes on the embedding collections and the state of the last build"""
+    try:
+        return describe_ann_indexes()
+    except Exception as e:
+        print(f"Error describing ANN indexes: {e}")
+        return JSONResponse(content={"error": f"Failed to describe ANN indexes: {str(e)}"}, status_code=500)
+
+@app.post("/vector-indexes")
+def build_vector_indexes(data: dict):
+    """
+    Build (or rebuild) the ANN indexes in the background.
+    Body: {"method": "hnsw" | "ivfflat", "m", "ef_construction", "lists", "rebuild": bool}
+    Omitted parameters fall back to the configured defaults. Poll GET /vector-indexes for progress.
+    """
+    method = data.get("method") or ANN_INDEX_METHOD
+    if method not in ANN_INDEX_METHODS:
+        return JSONResponse(content={"error": f"method must be one of {list(ANN_INDEX_METHODS)}"}, status_code=400)
+    try:
+        params = {key: int(data[key]) for key in ("m", "ef_construction", "lists") if data.get(key) is not None}
+    except (TypeError, ValueError):
+        return JSONResponse(content={"error": "m, ef_construction and lists must be integers"}, status_code=400)
+
+    if not run_ann_index_build(method=method, rebuild=bool(data.get("rebuild", False)), **params):
+        return JSONResponse(content={"error": "An ANN index build is already running"}, status_code=409)
+    return JSONResponse(content={"status": "building", "method": method, **params}, status_code=202)
 
 SUPPORTED_EXTENSIONS = {
     'docx', 'doc', 'pptx', 'ppt', 'xlsx', 'xls',
@@ -1472,11 +4406,7 @@ async def upload_files(
             content={"error": "No valid files provided", "errors": errors}
         )
 
-    # --------- PROCESSING PASS (only for files that passed checks) ---------
-    # Get vector stores
-    store = get_vector_store()
-    clip_store = get_clip_vector_store()
-
+    # --------- QUEUEING PASS (only for files that passed checks) ---------
     for file in files:
         filename = file.filename or "unnamed"
 
@@ -1496,171 +4426,70 @@ async def upload_files(
 
         # Now safe to read whole content into memory
         content = await file.read()
-        file_stream = io.BytesIO(content)
-
-        print(f"\n=== UPLOADING FILE: {filename} ({size_bytes} bytes) ===")
-
-        # Extract text, images, pdf_data (existing logic)
-        text, error, images, pdf_data = process_file_content(file_stream, filename)
-
-        print(
-            f"Processing results - Text length: {len(text) if text else 0}, "
-            f"Images found: {len(images)}, Error: {error}"
-        )
 
-        file_id = str(uuid.uuid4())
-        timestamp = int(time.time() * 1000)
-        pdf_filename = filename.rsplit('.', 1)[0] + '.pdf'
-        s3_key = (
-            f"modules/{moduleId}/{timestamp}-{pdf_filename}"
-            if moduleId
-            else f"uploads/{file_id}-{pdf_filename}"
-        )
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
+        print(f"\n=== QUEUEING FILE: {filename} ({size_bytes} bytes) ===")
 
         try:
-            if pdf_data:
-                s3.put_object(
-                    Bucket=S3_BUCKET_NAME,
-                    Key=s3_key,
-                    Body=pdf_data,
-                    ContentType='application/pdf'
-                )
-                print(f"Uploaded PDF to S3: {s3_key}")
-            else:
-                s3.put_object(
-                    Bucket=S3_BUCKET_NAME,
-                    Key=s3_key,
-                    Body=content,
-                    ContentType=file.content_type
-                )
-        except Exception as e:
-            print(f"S3 upload failed: {e}")
-            errors.append({"file_name": filename, "error": f"S3 upload failed: {e}"})
-            s3_key = None
-            s3_url = None
-
-        chunks = []
-        # OCR PROCESSING
-        ocr_text = ""
-        if ocr:
-            print("OCR flag enabled, extracting text with Groq...")
-            try:
-                ocr_stream = io.BytesIO(content)
-                ocr_text = extract_text_with_groq_ocr(ocr_stream, filename)
-                print(f"OCR extracted {len(ocr_text)} characters")
-
-                if ocr_text and len(ocr_text) > 10:
-                    text = ocr_text
-                    print("Using OCR text for vector storage")
-            except Exception as e:
-                print(f"OCR failed: {e}")
-                ocr_text = f"OCR failed: {str(e)}"
-
-        # Store text chunks in vector DB
-        if text and text.strip():
-            splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000, chunk_overlap=200
+            job = await run_in_threadpool(
+                create_ingestion_job, filename, content, file.content_type, moduleId, ocr
             )
-            chunks = splitter.split_text(text)
-
-            texts = chunks
-            metadatas = [{
-                "file_id": file_id,
-                "file_name": filename,
-                "chunk_index": i,
-                "file_type": (
-                    filename.lower().split('.')[-1]
-                    if '.' in filename else 'unknown'
-                ),
-                "content_type": "text",
-                "has_images": len(images) > 0,
-                "ocr_processed": ocr
-            } for i in range(len(chunks))]
-            ids = [str(uuid.uuid4()) for _ in chunks]
-
-            try:
-                store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
-                print(f"Stored {len(chunks)} text chunks in vector DB")
-            except Exception as e:
-                print(f"Failed to store text chunks: {e}")
-
-        # Store image descriptions in CLIP vector store
-        images_stored = 0
-        if images and len(images) > 0:
-            print(f"Processing {len(images)} images for CLIP storage...")
-            for img_index, img in enumerate(images):
-                print(f"  Processing image {img_index + 1}/{len(images)}...")
-                try:
-                    description = generate_image_description(img)
-                    print(f"  Generated description: {description[:100]}...")
-
-                    metadata = {
-                        "file_id": file_id,
-                        "file_name": filename,
-                        "image_index": img_index,
-                        "file_type": "image",
-                        "content_type": "image",
-                        "original_content": description[:500]
-                    }
-
-                    clip_store.add_texts(
-                        texts=[description],
-                        metadatas=[metadata],
-                        ids=[str(uuid.uuid4())]
-                    )
+        except Exception as e:
+            print(f"Failed to queue {filename}: {e}")
+            errors.append({"file_name": filename, "error": f"Failed to queue file for processing: {e}"})
+            continue
 
-                    images_stored += 1
-                    print(f"  Successfully stored image {img_index + 1}")
-                except Exception as e:
-                    print(f"  Failed to process/store image {img_index}: {e}")
-            print(f"Total images stored in CLIP: {images_stored}/{len(images)}")
-        else:
-            print("No images found to store in CLIP")
+        submit_ingestion_job(job["job_id"])
 
         results.append({
             "file_name": filename,
-            "file_id": file_id,
-            "chunks": len(chunks),
-            "images_processed": len(images),
+            "file_id": job["file_id"],
+            "job_id": job["job_id"],
+            "status": "queued",
+            "status_url": f"/jobs/{job['job_id']}",
             "file_type": (
                 filename.lower().split('.')[-1]
                 if '.' in filename else 'unknown'
             ),
-            "s3_key": s3_key,
-            "s3_url": s3_url,
+            "s3_key": job["s3_key"],
+            "s3_url": job["s3_url"],
             "html": None,
-            "error": error,
-            "debug_info": {
-                "text_extracted": len(text) if text else 0,
-                "images_found": len(images),
-                "images_stored_in_clip": images_stored
-            }
+            "error": None
         })
 
-        print(f"=== COMPLETED: {filename} ===\n")
-
     response_data = {"uploaded": results}
     if errors:
         response_data["errors"] = errors
 
-    return JSONResponse(content=response_data, status_code=201)
+    return JSONResponse(content=response_data, status_code=202)
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Per-stage progress and timings for an ingestion job"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid job id")
+    try:
+        job = describe_ingestion_job(job_id)
+    except Exception as e:
+        return JSONResponse(content={"error": f"Failed to load job: {str(e)}"}, status_code=500)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 class AskRequest(BaseModel):
     question: str
     file_ids: list[str]
 
 
-@app.post("/ask")
-def ask(data: AskRequest):
-    question = data.question.strip()
-    file_ids = data.file_ids
-
-    if not file_ids:
-        raise HTTPException(status_code=400, detail="file_ids are required")
+ASK_SYSTEM_PROMPT = "You are analyzing document content provided by the user. The user will provide text excerpts and descriptions of any images/diagrams. Answer their questions using this provided content. When referring to visual content, do so naturally (e.g., 'the diagram shows', 'as seen in the graph', 'the illustration demonstrates')."
 
-    # 1. Get relevant content (text + images)
-    text_chunks, image_descriptions = retrieve_by_file_ids(file_ids, question, k=8)
+def build_ask_messages(question, file_ids, chat_history):
+    """Retrieve and pack context for a question and build the Groq messages; returns (messages, packed context)"""
+    # 1. Get relevant content (text + images), packed into the token budget
+    scored_text, scored_images = retrieve_by_file_ids(file_ids, question, k=8, with_scores=True)
+    packed = pack_context(scored_text, scored_images, "ask")
+    text_chunks, image_descriptions = packed["text"], packed["images"]
     
     # DEBUG: Print what we retrieved
     print(f"DEBUG: Retrieved {len(text_chunks)} text chunks, {len(image_descriptions)} image descriptions")
@@ -1687,16 +4516,11 @@ def ask(data: AskRequest):
     
     context = "\n\n".join(context_parts) if context_parts else "No content found."
     
-    # 3. Get chat history
-    chat_history = get_chat_history(file_ids, limit=3)
-    
-    # 4. Call Groq with BETTER system prompt
-    client = Groq(api_key=GROQ_API_KEY)
-    
+    # 3. Build messages with BETTER system prompt
     messages = [
         {
             "role": "system", 
-            "content": "You are analyzing document content provided by the user. The user will provide text excerpts and descriptions of any images/diagrams. Answer their questions using this provided content. When referring to visual content, do so naturally (e.g., 'the diagram shows', 'as seen in the graph', 'the illustration demonstrates')."
+            "content": ASK_SYSTEM_PROMPT
         }
     ]
     
@@ -1715,10 +4539,62 @@ Question: {question}
 Please answer based on the document content above."""
     
     messages.append({"role": "user", "content": user_message})
-    
+    return messages, packed
+
+def ask_chat_history(question, file_ids):
+    """
+    Recent turns for a follow-up question, [] for a standalone one. Standalone
+    questions are answered from the documents alone, so their answers do not
+    depend on the conversation and can be served from the answer cache.
+    """
+    if not is_follow_up_question(question):
+        return []
+    return get_chat_history(file_ids, limit=3)
+
+def lookup_cached_answer(file_ids, question_embedding, started, chat_history):
+    """
+    Answer cache lookup shared by /ask and /ask-stream; books the latency saved on a hit.
+    Follow-up questions are answered in the context of the conversation, so the cache
+    is only used (and only stored to) for questions answered without chat history.
+    """
+    if chat_history:
+        return None
+    cached = find_cached_answer(file_ids, question_embedding)
+    if cached is not None:
+        lookup_ms = (time.perf_counter() - started) * 1000
+        answer_cache_stats.add("latency_saved_ms", max(0.0, cached["generation_ms"] - lookup_ms))
+        print(f"Answer cache hit (similarity {cached['similarity']}): {cached['question'][:80]}")
+    return cached
+
+@app.post("/ask")
+def ask(data: AskRequest):
+    question = data.question.strip()
+    file_ids = data.file_ids
+
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="file_ids are required")
+
+    # 0. Reuse the answer to a near-identical question about the same files
+    started = time.perf_counter()
+    question_embedding = get_text_query_embedding(question)
+    chat_history = ask_chat_history(question, file_ids)
+    cached = lookup_cached_answer(file_ids, question_embedding, started, chat_history)
+    if cached is not None:
+        for file_id in file_ids:
+            save_chat_history(file_id, question, cached["answer"])
+        return JSONResponse(content={
+            "question": question,
+            "answer": cached["answer"],
+            "debug_info": {
+                "cache_hit": True,
+                "cached_question": cached["question"],
+                "similarity": cached["similarity"]
+            }
+        })
+
+    messages, packed = build_ask_messages(question, file_ids, chat_history)
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        response = llm_gateway.chat(
             messages=messages,
             max_tokens=2048,
             temperature=0.1
@@ -1729,14 +4605,21 @@ Please answer based on the document content above."""
         # 5. Save to history
         for file_id in file_ids:
             save_chat_history(file_id, question, answer)
+        if not chat_history:
+            store_cached_answer(
+                file_ids, question, question_embedding, answer,
+                (time.perf_counter() - started) * 1000
+            )
 
         return JSONResponse(content={
             "question": question,
             "answer": answer,
             "debug_info": {
-                "text_chunks_retrieved": len(text_chunks),
-                "image_descriptions_retrieved": len(image_descriptions),
-                "has_images": len(image_descriptions) > 0
+                "cache_hit": False,
+                "text_chunks_retrieved": len(packed["text"]),
+                "image_descriptions_retrieved": len(packed["images"]),
+                "has_images": len(packed["images"]) > 0,
+                **context_debug_info(packed)
             }
         })
         
@@ -1744,26 +4627,98 @@ Please answer based on the document content above."""
         error_msg = f"Groq API error: {e}"
         print(error_msg)
         return JSONResponse(content={"error": error_msg}, status_code=500)
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.post("/ask-stream")
+def ask_stream(data: AskRequest):
+    """
+    Server-Sent Events variant of /ask. Events:
+    - meta:  retrieval debug info, sent before generation starts
+    - token: {"text": ...} for each piece of the answer as Groq produces it
+    - done:  the full answer, sent after it has been saved to chat history
+    - error: {"error": ...} if generation fails
+    """
+    question = data.question.strip()
+    file_ids = data.file_ids
+
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="file_ids are required")
+
+    def events():
+        started = time.perf_counter()
+        question_embedding = get_text_query_embedding(question)
+        chat_history = ask_chat_history(question, file_ids)
+        cached = lookup_cached_answer(file_ids, question_embedding, started, chat_history)
+        if cached is not None:
+            for file_id in file_ids:
+                save_chat_history(file_id, question, cached["answer"])
+            yield sse_event("meta", {
+                "cache_hit": True,
+                "cached_question": cached["question"],
+                "similarity": cached["similarity"]
+            })
+            yield sse_event("token", {"text": cached["answer"]})
+            yield sse_event("done", {"question": question, "answer": cached["answer"]})
+            return
+
+        messages, packed = build_ask_messages(question, file_ids, chat_history)
+        yield sse_event("meta", {
+            "cache_hit": False,
+            "text_chunks_retrieved": len(packed["text"]),
+            "image_descriptions_retrieved": len(packed["images"]),
+            "has_images": len(packed["images"]) > 0,
+            **context_debug_info(packed)
+        })
+
+        parts = []
+        try:
+            for text in llm_gateway.stream(messages=messages, max_tokens=2048, temperature=0.1):
+                parts.append(text)
+                yield sse_event("token", {"text": text})
+        except Exception as e:
+            error_msg = f"Groq API error: {e}"
+            print(error_msg)
+            yield sse_event("error", {"error": error_msg})
+            return
+
+        # Persist once the stream has finished, same as /ask
+        answer = "".join(parts)
+        for file_id in file_ids:
+            save_chat_history(file_id, question, answer)
+        if not chat_history:
+            store_cached_answer(
+                file_ids, question, question_embedding, answer,
+                (time.perf_counter() - started) * 1000
+            )
+        yield sse_event("done", {"question": question, "answer": answer})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
     
 @app.get("/file-ids")
 def list_file_ids():
     try:
-        cur = conn.cursor()
-        cur.execute(f"""
-            SELECT DISTINCT {TABLE_NAME}.cmetadata->>'file_id' AS file_id,
-                            {TABLE_NAME}.cmetadata->>'file_name' AS file_name
-            FROM {TABLE_NAME}
-            ORDER BY file_name
-        """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.commit()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT DISTINCT {TABLE_NAME}.cmetadata->>'file_id' AS file_id,
+                                {TABLE_NAME}.cmetadata->>'file_name' AS file_name
+                FROM {TABLE_NAME}
+                ORDER BY file_name
+            """)
+            rows = cur.fetchall()
+            cur.close()
+            conn.commit()
 
         files = [{"file_id": r[0], "file_name": r[1]} for r in rows]
         return JSONResponse(content={"files": files}, status_code=200)
 
     except Exception as e:
-        conn.rollback()
         return JSONResponse(content={"error": str(e)}, status_code=500)
     
 @app.get("/chat-history")
@@ -1785,19 +4740,19 @@ def clear_chat_history(data: dict):
     file_ids = data.get("file_ids", [])
 
     try:
-        cur = conn.cursor()
-        placeholders = ','.join(['%s'] * len(file_ids))
-        cur.execute(f"DELETE FROM chat_history WHERE file_id IN ({placeholders})", file_ids)
+        with db_connection() as conn:
+            cur = conn.cursor()
+            placeholders = ','.join(['%s'] * len(file_ids))
+            cur.execute(f"DELETE FROM chat_history WHERE file_id IN ({placeholders})", file_ids)
 
-        conn.commit()
-        cur.close()
+            conn.commit()
+            cur.close()
 
         return {
             "message": "Chat history cleared successfully",
             "file_ids": file_ids
         }
     except Exception as e:
-        conn.rollback()
         return JSONResponse(content={"error": f"Failed to clear history: {str(e)}"}, status_code=500)
 
 @app.post("/generate-flashcards")
@@ -1844,15 +4799,11 @@ def generate_flashcards(data: dict):
         level = requested_level
 
         # Build context for flashcards
-        search_terms = [
-            "key concepts",
-            "important information",
-            "main topics",
-            "detailed explanations",
-        ]
-        random_term = random.choice(search_terms)
+        random_term = random.choice(FLASHCARD_SEARCH_TERMS)
 
-        context_chunks, _ = retrieve_by_file_ids(file_ids, random_term, k=6)
+        scored_chunks, _ = retrieve_by_file_ids(file_ids, random_term, k=6, with_scores=True)
+        packed = pack_context(scored_chunks, budget_name="flashcards")
+        context_chunks = packed["text"]
         context = "\n---\n".join(context_chunks) if context_chunks else "No content found."
 
         if not context.strip():
@@ -1878,6 +4829,10 @@ def generate_flashcards(data: dict):
                 "next_available_level": next_available,
                 "all_levels_completed": len(completed_levels) == 3,
             },
+            "debug_info": {
+                "text_chunks_used": len(context_chunks),
+                **context_debug_info(packed)
+            },
         }
 
     except HTTPException:
@@ -2006,21 +4961,13 @@ def enhance_notes(data: dict):
     if not file_ids:
         raise HTTPException(status_code=400, detail="file_ids are required")
     
-    # Get comprehensive context including images
-    all_text_chunks = []
-    all_image_descriptions = []
+    # Get comprehensive context including images - all search terms in one round trip
+    scored_text, scored_images = retrieve_for_queries(file_ids, ENHANCE_NOTES_SEARCH_TERMS, k=8, with_scores=True)
     
-    # Try multiple searches
-    for term in ["comprehensive understanding", "detailed information", "key concepts visual content"]:
-        text_chunks, image_descriptions = retrieve_by_file_ids(file_ids, term, k=8)
-        
-        for chunk in text_chunks:
-            if chunk not in all_text_chunks:
-                all_text_chunks.append(chunk)
-        
-        for desc in image_descriptions:
-            if desc not in all_image_descriptions:
-                all_image_descriptions.append(desc)
+    # Best-scoring, non-duplicate content that fits the token budget
+    packed = pack_context(scored_text, scored_images, "enhance_notes")
+    all_text_chunks = packed["text"]
+    all_image_descriptions = packed["images"]
     
     # Build context
     context_parts = []
@@ -2049,7 +4996,8 @@ def enhance_notes(data: dict):
             "text_chunks": len(all_text_chunks),
             "images": len(all_image_descriptions),
             "total_content": f"{len(all_text_chunks)} text chunks, {len(all_image_descriptions)} images"
-        }
+        },
+        "debug_info": context_debug_info(packed)
     }
 
 @app.post("/generate-mcq")
@@ -2060,29 +5008,13 @@ def generate_mcq(data: dict):
     if not file_ids:
         raise HTTPException(status_code=400, detail="file_ids are required")
     
-    # Use search terms that capture ALL content types
-    search_terms = [
-        "key concepts definitions important points",
-        "formulas equations calculations data",
-        "diagrams images charts visual information",
-        "processes methods steps procedures",
-        "facts information details explanations"
-    ]
-    
-    # Collect content from multiple searches
-    all_text_chunks = []
-    all_image_descriptions = []
+    # Use search terms that capture ALL content types - all in one retrieval round trip
+    scored_text, scored_images = retrieve_for_queries(file_ids, MCQ_SEARCH_TERMS[:3], k=6, with_scores=True)
     
-    for term in search_terms[:3]:  # Try first 3 terms
-        text_chunks, image_descriptions = retrieve_by_file_ids(file_ids, term, k=6)
-        
-        for chunk in text_chunks:
-            if chunk not in all_text_chunks:
-                all_text_chunks.append(chunk)
-        
-        for desc in image_descriptions:
-            if desc not in all_image_descriptions:
-                all_image_descriptions.append(desc)
+    # Best-scoring, non-duplicate content that fits the token budget
+    packed = pack_context(scored_text, scored_images, "mcq")
+    all_text_chunks = packed["text"]
+    all_image_descriptions = packed["images"]
     
     print(f"MCQ DEBUG: Text chunks: {len(all_text_chunks)}, Images: {len(all_image_descriptions)}")
     
@@ -2090,7 +5022,7 @@ def generate_mcq(data: dict):
     context_parts = []
     
     if all_text_chunks:
-        text_context = "DOCUMENT TEXT CONTENT:\n" + "\n---\n".join(all_text_chunks[:12])  # Limit to reasonable size
+        text_context = "DOCUMENT TEXT CONTENT:\n" + "\n---\n".join(all_text_chunks)
         context_parts.append(text_context)
     
     if all_image_descriptions:
@@ -2108,7 +5040,9 @@ def generate_mcq(data: dict):
     
     # Last resort if no content
     if not context_parts:
-        all_text_chunks, all_image_descriptions = retrieve_by_file_ids(file_ids, "", k=15)
+        scored_text, scored_images = retrieve_by_file_ids(file_ids, "", k=15, with_scores=True)
+        packed = pack_context(scored_text, scored_images, "mcq")
+        all_text_chunks, all_image_descriptions = packed["text"], packed["images"]
         
         combined = []
         if all_text_chunks:
@@ -2137,7 +5071,8 @@ def generate_mcq(data: dict):
         "debug_info": {
             "text_chunks_used": len(all_text_chunks),
             "image_descriptions_used": len(all_image_descriptions),
-            "context_length": len(context)
+            "context_length": len(context),
+            **context_debug_info(packed)
         }
     }
 @app.post("/delete-file-embeddings")
@@ -2149,25 +5084,34 @@ def delete_file_embeddings(data: dict):
         return JSONResponse(content={"error": "file_ids are required"}, status_code=400)
     
     try:
-        cur = conn.cursor()
-        
         placeholders = ','.join(['%s'] * len(file_ids))
         
         deleted_embeddings = 0
         deleted_clip_embeddings = 0
         deleted_chat_history = 0
         
-        cur.execute(f"DELETE FROM {TABLE_NAME} WHERE cmetadata->>'file_id' IN ({placeholders})", file_ids)
-        deleted_embeddings = cur.rowcount
-        
-        cur.execute(f"DELETE FROM {TABLE_NAME}_clip WHERE cmetadata->>'file_id' IN ({placeholders})", file_ids)
-        deleted_clip_embeddings = cur.rowcount
-        
-        cur.execute(f"DELETE FROM chat_history WHERE file_id IN ({placeholders})", file_ids)
-        deleted_chat_history = cur.rowcount
+        with db_connection() as conn:
+            cur = conn.cursor()
+            
+            # Text and CLIP vectors share one table; count them per collection
+            cur.execute(f"""
+                DELETE FROM {TABLE_NAME} WHERE cmetadata->>'file_id' = ANY(%s)
+                RETURNING collection_id
+            """, (list(file_ids),))
+            deleted_collections = [str(row[0]) for row in cur.fetchall()]
+            clip_collection_id = get_collection_id(cur, f"{TABLE_NAME}_clip")
+            deleted_clip_embeddings = deleted_collections.count(clip_collection_id) if clip_collection_id else 0
+            deleted_embeddings = len(deleted_collections) - deleted_clip_embeddings
+            
+            cur.execute(f"DELETE FROM chat_history WHERE file_id IN ({placeholders})", file_ids)
+            deleted_chat_history = cur.rowcount
+            
+            conn.commit()
+            cur.close()
         
-        conn.commit()
-        cur.close()
+        forget_ingest_cache_entries(file_ids)
+        invalidate_answer_cache(file_ids)
+        invalidate_file_matrices(file_ids)
         
         return {
             "message": "File embeddings and chat history deleted successfully",
@@ -2177,7 +5121,6 @@ def delete_file_embeddings(data: dict):
             "file_ids": file_ids
         }
     except Exception as e:
-        conn.rollback()
         print(f"Error deleting embeddings: {e}")
         return JSONResponse(content={"error": f"Failed to delete embeddings: {str(e)}"}, status_code=500)
 
@@ -2267,59 +5210,58 @@ def check_database(data: dict):
         return {"error": "No file_ids provided"}
     
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        with db_connection() as conn:
+            cur = conn.cursor()
         
-        placeholders = ','.join(['%s'] * len(file_ids))
+            placeholders = ','.join(['%s'] * len(file_ids))
         
-        results = {
-            "file_ids": file_ids,
-            "text_store": [],
-            "clip_store": []
-        }
+            results = {
+                "file_ids": file_ids,
+                "text_store": [],
+                "clip_store": []
+            }
         
-        # Check text store
-        cur.execute(f"""
-            SELECT 
-                cmetadata->>'file_id' as file_id,
-                cmetadata->>'file_name' as file_name,
-                COUNT(*) as count,
-                cmetadata->>'content_type' as content_type
-            FROM {TABLE_NAME}
-            WHERE cmetadata->>'file_id' IN ({placeholders})
-            GROUP BY cmetadata->>'file_id', cmetadata->>'file_name', cmetadata->>'content_type'
-        """, file_ids)
-        
-        for row in cur.fetchall():
-            results["text_store"].append({
-                "file_id": row[0],
-                "file_name": row[1],
-                "count": row[2],
-                "content_type": row[3]
-            })
+            # Check text store
+            cur.execute(f"""
+                SELECT 
+                    cmetadata->>'file_id' as file_id,
+                    cmetadata->>'file_name' as file_name,
+                    COUNT(*) as count,
+                    cmetadata->>'content_type' as content_type
+                FROM {TABLE_NAME}
+                WHERE cmetadata->>'file_id' IN ({placeholders})
+                GROUP BY cmetadata->>'file_id', cmetadata->>'file_name', cmetadata->>'content_type'
+            """, file_ids)
         
-        # Check CLIP store
-        cur.execute(f"""
-            SELECT 
-                cmetadata->>'file_id' as file_id,
-                cmetadata->>'file_name' as file_name,
-                COUNT(*) as count,
-                cmetadata->>'content_type' as content_type
-            FROM {TABLE_NAME}_clip
-            WHERE cmetadata->>'file_id' IN ({placeholders})
-            GROUP BY cmetadata->>'file_id', cmetadata->>'file_name', cmetadata->>'content_type'
-        """, file_ids)
-        
-        for row in cur.fetchall():
-            results["clip_store"].append({
-                "file_id": row[0],
-                "file_name": row[1],
-                "count": row[2],
-                "content_type": row[3]
-            })
+            for row in cur.fetchall():
+                results["text_store"].append({
+                    "file_id": row[0],
+                    "file_name": row[1],
+                    "count": row[2],
+                    "content_type": row[3]
+                })
         
-        cur.close()
-        conn.close()
+            # Check CLIP store
+            cur.execute(f"""
+                SELECT 
+                    cmetadata->>'file_id' as file_id,
+                    cmetadata->>'file_name' as file_name,
+                    COUNT(*) as count,
+                    cmetadata->>'content_type' as content_type
+                FROM {TABLE_NAME}_clip
+                WHERE cmetadata->>'file_id' IN ({placeholders})
+                GROUP BY cmetadata->>'file_id', cmetadata->>'file_name', cmetadata->>'content_type'
+            """, file_ids)
+        
+            for row in cur.fetchall():
+                results["clip_store"].append({
+                    "file_id": row[0],
+                    "file_name": row[1],
+                    "count": row[2],
+                    "content_type": row[3]
+                })
+            
+            cur.close()
         
         return results
         
@@ -2331,8 +5273,6 @@ def check_database(data: dict):
 #----------------------------OCR------------------------
 def extract_text_with_groq_ocr(file_stream, filename):
     """Extract text from ANY file using Groq's OCR capability"""
-    client = Groq(api_key=GROQ_API_KEY)
-    
     # Reset stream position
     file_stream.seek(0)
     
@@ -2344,98 +5284,353 @@ def extract_text_with_groq_ocr(file_stream, filename):
     
     if file_ext in ['pdf', 'docx', 'pptx', 'txt']:
         # Convert document to image(s) first
-        return extract_text_from_document_with_ocr(file_bytes, filename, client)
+        return extract_text_from_document_with_ocr(file_bytes, filename)
     else:
         # Direct OCR for image files
-        return extract_text_from_image(file_bytes, client)
+        return extract_text_from_image(file_bytes)
+
+
+# OCR runs pages concurrently; each page is rendered when a slot frees up and encoded once
+OCR_CONCURRENCY = int(os.environ.get("OCR_CONCURRENCY", "4"))
+OCR_RENDER_SCALE = float(os.environ.get("OCR_RENDER_SCALE", "2"))
+OCR_IMAGE_FORMAT = os.environ.get("OCR_IMAGE_FORMAT", "jpeg").lower()  # "jpeg" or "webp"
+OCR_IMAGE_QUALITY = int(os.environ.get("OCR_IMAGE_QUALITY", "85"))
+OCR_RETRIES = int(os.environ.get("OCR_RETRIES", str(GROQ_RATE_LIMIT_RETRIES)))
+OCR_IMAGE_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+OCR_IMAGE_PROMPT = "Extract ALL text from this image. Return ONLY the text, no explanations."
+OCR_PAGE_PROMPT = "Extract ALL text from this document page. Return ONLY the text, no explanations."
+# Page classifier: only pages without a usable text layer are sent to OCR
+OCR_ALL_PAGES = os.environ.get("OCR_ALL_PAGES", "false").lower() == "true"
+OCR_MIN_TEXT_CHARS = int(os.environ.get("OCR_MIN_TEXT_CHARS", "50"))
+OCR_MAX_IMAGE_COVERAGE = float(os.environ.get("OCR_MAX_IMAGE_COVERAGE", "0.5"))
+OCR_MIN_GLYPH_VALIDITY = float(os.environ.get("OCR_MIN_GLYPH_VALIDITY", "0.9"))
+OCR_MIN_REGION_SHARE = float(os.environ.get("OCR_MIN_REGION_SHARE", "0.02"))  # smaller images (logos, icons) are not OCRed
+ocr_stats = Counters(pages_classified=0, pages_ocr=0, pages_native=0)
+
+# OCR results keyed by (bitmap hash, model, prompt version): byte-bounded LRU in front of Postgres.
+# Bump OCR_PROMPT_VERSION whenever the OCR prompts or render settings change meaningfully.
+OCR_PROMPT_VERSION = "1"
+OCR_CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+ocr_cache = LRUCache(max_bytes=OCR_CACHE_MAX_BYTES, sizeof=lambda text: len(text.encode("utf-8")))
+ocr_cache_stats = Counters(db_hits=0, misses=0, stored=0)
+ocr_cache_table_ready = False
+
+def ensure_ocr_cache_table():
+    global ocr_cache_table_ready
+    if ocr_cache_table_ready:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    image_hash CHAR(64) NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    hits INT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_hit_at TIMESTAMP,
+                    PRIMARY KEY (image_hash, model, prompt_version)
+                )
+            """)
+            conn.commit()
+            cur.close()
+        ocr_cache_table_ready = True
+        return True
+    except Exception as e:
+        print(f"Error ensuring ocr_cache table: {e}")
+        return False
+
+def ocr_prompt_version(prompt_kind):
+    # Page and standalone-image OCR use different prompts, so they never share entries
+    return f"{prompt_kind}-v{OCR_PROMPT_VERSION}"
+
+def get_cached_ocr_text(image_hash, prompt_kind):
+    cache_key = (image_hash, GROQ_MODEL, ocr_prompt_version(prompt_kind))
+    text = ocr_cache.get(cache_key)
+    if text is not None:
+        return text
+    if not ensure_ocr_cache_table():
+        ocr_cache_stats.add("misses")
+        return None
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE ocr_cache
+                SET hits = hits + 1, last_hit_at = %s
+                WHERE image_hash = %s AND model = %s AND prompt_version = %s
+                RETURNING text
+            """, (datetime.now(), *cache_key))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"  OCR cache lookup failed: {e}")
+        ocr_cache_stats.add("misses")
+        return None
+    if row is None:
+        ocr_cache_stats.add("misses")
+        return None
+    ocr_cache_stats.add("db_hits")
+    ocr_cache.put(cache_key, row[0])
+    return row[0]
+
+def store_ocr_text(image_hash, prompt_kind, text):
+    cache_key = (image_hash, GROQ_MODEL, ocr_prompt_version(prompt_kind))
+    ocr_cache.put(cache_key, text)
+    if not ensure_ocr_cache_table():
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO ocr_cache (image_hash, model, prompt_version, text)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (image_hash, model, prompt_version) DO UPDATE SET text = EXCLUDED.text
+            """, (*cache_key, text))
+            conn.commit()
+            cur.close()
+        ocr_cache_stats.add("stored")
+    except Exception as e:
+        print(f"  Failed to cache OCR text: {e}")
 
+def encode_ocr_image(image):
+    """Encode a page/image once for OCR; returns (bytes, mime type)"""
+    pil_format, mime = OCR_IMAGE_FORMATS.get(OCR_IMAGE_FORMAT, OCR_IMAGE_FORMATS["jpeg"])
+    buffer = io.BytesIO()
+    normalize_image(image).save(buffer, format=pil_format, quality=OCR_IMAGE_QUALITY)
+    return buffer.getvalue(), mime
 
-def extract_text_from_image(image_bytes, client):
-    """Extract text from image bytes using Groq"""
+def request_ocr(image_bytes, mime, prompt, max_tokens):
+    """One Groq OCR call through the LLM gateway (which retries rate limits and transient errors)"""
     img_b64 = base64.b64encode(image_bytes).decode('utf-8')
-    
-    # Simple OCR prompt - JUST EXTRACT TEXT
-    response = client.chat.completions.create(
-        model=GROQ_MODEL,
+    response = llm_gateway.chat(
         messages=[{
             "role": "user",
             "content": [
-                {"type": "text", "text": "Extract ALL text from this image. Return ONLY the text, no explanations."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{img_b64}"}}
             ]
         }],
-        max_tokens=2000,
-        temperature=0.1
+        max_tokens=max_tokens,
+        temperature=0.1,
+        retries=OCR_RETRIES
     )
+    return (response.choices[0].message.content or "").strip()
+
+def ocr_image_cached(image, prompt_kind, max_tokens):
+    """OCR a decoded image, consulting the OCR cache before encoding it and calling Groq"""
+    image_hash = hash_image(image)
+    text = get_cached_ocr_text(image_hash, prompt_kind)
+    if text is not None:
+        return text
+    image_bytes, mime = encode_ocr_image(image)
+    prompt = OCR_PAGE_PROMPT if prompt_kind == "page" else OCR_IMAGE_PROMPT
+    text = request_ocr(image_bytes, mime, prompt, max_tokens)
+    if text:
+        store_ocr_text(image_hash, prompt_kind, text)
+    return text
+
+def extract_text_from_image(image_bytes):
+    """Extract text from image bytes using Groq, cached by the decoded bitmap"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image_hash = hash_image(image)
+    text = get_cached_ocr_text(image_hash, "image")
+    if text is not None:
+        print(f"  OCR cache hit ({image_hash[:12]})")
+        return text
+    
+    mime = Image.MIME.get(image.format)
+    if mime not in ("image/jpeg", "image/png", "image/webp"):
+        # Re-encode formats the vision model may not accept (TIFF, BMP, ...)
+        image_bytes, mime = encode_ocr_image(image)
     
-    return response.choices[0].message.content.strip()
+    # Simple OCR prompt - JUST EXTRACT TEXT
+    text = request_ocr(image_bytes, mime, OCR_IMAGE_PROMPT, max_tokens=2000)
+    if text:
+        store_ocr_text(image_hash, "image", text)
+    return text
+
+def get_ocr_metrics():
+    pages = ocr_stats.snapshot()
+    classified = pages["pages_classified"]
+    memory = ocr_cache.metrics()
+    stats = ocr_cache_stats.snapshot()
+    hits = memory["hits"] + stats["db_hits"]
+    lookups = hits + stats["misses"]
+    return {
+        **pages,
+        "ocr_rate": round(pages["pages_ocr"] / classified, 3) if classified else None,
+        "cache": {
+            "memory_hits": memory["hits"],
+            "db_hits": stats["db_hits"],
+            "misses": stats["misses"],
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "stored": stats["stored"],
+            "memory_entries": memory["entries"],
+            "memory_bytes": memory["bytes"]
+        }
+    }
+
+def glyph_validity(text):
+    """Share of non-space characters that are real glyphs (not U+FFFD, control, private-use or unassigned)"""
+    chars = [ch for ch in text if not ch.isspace()]
+    if not chars:
+        return 0.0
+    invalid = sum(1 for ch in chars if ch == "\ufffd" or unicodedata.category(ch) in ("Cc", "Co", "Cn"))
+    return 1 - invalid / len(chars)
+
+def image_coverage(page):
+    """Fraction of the page area covered by images (overlaps are not subtracted)"""
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        covered += abs(fitz.Rect(info["bbox"]) & page.rect)
+    return min(1.0, covered / page_area)
+
+def classify_pdf_page(page):
+    """
+    Decide from the native text layer whether a page needs OCR:
+    - "native": valid text and no images worth reading (title slides and dividers stay native)
+    - "scanned": no text, unreadable text (broken font encoding), or a few characters on a page of images
+    - "mixed": readable text plus images that may hold more; only the images are OCRed
+    Returns (kind, native text, signals).
+    """
+    text = page.get_text("text")
+    chars = len(text.strip())
+    validity = glyph_validity(text)
+    coverage = image_coverage(page)
+    signals = {"chars": chars, "glyph_validity": round(validity, 3), "image_coverage": round(coverage, 3)}
+    if chars == 0 or validity < OCR_MIN_GLYPH_VALIDITY:
+        return "scanned", text, signals
+    if coverage >= OCR_MAX_IMAGE_COVERAGE:
+        return ("scanned" if chars < OCR_MIN_TEXT_CHARS else "mixed"), text, signals
+    if chars < OCR_MIN_TEXT_CHARS and coverage > 0:
+        return "mixed", text, signals
+    return "native", text, signals
+
+def merge_page_text(kind, native_text, ocr_text):
+    """Native text wins where it is readable; OCR fills scanned pages and adds the images' text on mixed ones"""
+    native_text = native_text.strip()
+    ocr_text = (ocr_text or "").strip()
+    if not ocr_text:
+        return native_text
+    if kind == "scanned":
+        return ocr_text
+    if kind == "mixed":
+        return f"{native_text}\n{ocr_text}"
+    return native_text
+
+def ocr_image_regions(page):
+    """Rects of the page's images worth OCRing: clipped to the page, deduplicated, tiny ones skipped"""
+    page_area = abs(page.rect)
+    regions = []
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page.rect
+        if page_area and abs(rect) / page_area >= OCR_MIN_REGION_SHARE and rect not in regions:
+            regions.append(rect)
+    return regions
+
+def render_pages_for_ocr(pdf_data, page_numbers=None, region_pages=()):
+    """
+    Render PDF pages (all, or only page_numbers) one at a time as RGB images, straight
+    from the pixmap. Yields (page_index, prompt kind, image): whole pages with the "page"
+    prompt, and for region_pages each image area alone with the "image" prompt, so the
+    page's native text is not OCRed a second time.
+    """
+    doc = fitz.open(stream=pdf_data, filetype="pdf")
+    try:
+        matrix = fitz.Matrix(OCR_RENDER_SCALE, OCR_RENDER_SCALE)  # Higher resolution for OCR
+        for page_number in (range(len(doc)) if page_numbers is None else page_numbers):
+            page = doc[page_number]
+            if page_number in region_pages:
+                for rect in ocr_image_regions(page):
+                    pix = page.get_pixmap(matrix=matrix, clip=rect, colorspace=fitz.csRGB, alpha=False)
+                    yield page.number, "image", pixmap_to_image(pix)
+                    pix = None
+                continue
+            pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csRGB, alpha=False)
+            yield page.number, "page", pixmap_to_image(pix)
+            pix = None
+    finally:
+        doc.close()
 
+def ocr_pdf_pages(pdf_data, page_numbers=None, region_pages=()):
+    """
+    OCR the pages of a PDF (all, or only page_numbers) with up to OCR_CONCURRENCY
+    requests in flight; pages in region_pages are OCRed image by image. Rendering
+    waits while OCR_CONCURRENCY * 2 images are pending, so rendered images never
+    pile up. Returns {page_index: text} in page order ("" for failed pages).
+    """
+    slots = threading.BoundedSemaphore(OCR_CONCURRENCY * 2)
 
-def extract_text_from_document_with_ocr(file_bytes, filename, client):
-    """Extract text from documents by converting pages to images and OCRing each"""
-    # Convert PDF/DOC to images
-    images = []
-    
+    def ocr_page(page_index, prompt_kind, image):
+        try:
+            return ocr_image_cached(image, prompt_kind, max_tokens=1000)
+        except Exception as e:
+            print(f"  OCR failed for page {page_index + 1}: {e}")
+            return ""
+        finally:
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr") as pool:
+        for page_index, prompt_kind, image in render_pages_for_ocr(pdf_data, page_numbers, region_pages):
+            slots.acquire()
+            futures.append((page_index, pool.submit(ocr_page, page_index, prompt_kind, image)))
+        print(f"  OCRing {len(futures)} page images, {OCR_CONCURRENCY} at a time...")
+        texts = {}
+        for page_index, future in futures:
+            text = future.result().strip()
+            texts[page_index] = f"{texts[page_index]}\n{text}".strip() if page_index in texts else text
+        return texts
+
+def extract_text_from_document_with_ocr(file_bytes, filename):
+    """
+    Extract text from documents page by page: pages with a usable text layer keep
+    their native text, the rest are rendered and OCRed concurrently, and the two
+    are merged per page.
+    """
     file_ext = filename.lower().split('.')[-1]
     
+    pdf_data = None
     if file_ext == 'pdf':
-        # Convert PDF pages to images
-        import fitz
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # Higher resolution for OCR
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            images.append(img)
-        
-        doc.close()
-    
+        pdf_data = file_bytes
     elif file_ext in ['docx', 'pptx']:
         # Convert office docs to PDF then to images
-        # (Use your existing convert_office_to_pdf function)
         pdf_data, error = convert_office_to_pdf(io.BytesIO(file_bytes), filename)
-        if pdf_data:
-            # Convert PDF to images as above
-            doc = fitz.open(stream=pdf_data, filetype="pdf")
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                img_data = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_data))
-                images.append(img)
-            doc.close()
+    if not pdf_data:
+        return ""
     
-    # OCR each image
-    all_text = []
-    for i, img in enumerate(images):
-        print(f"  OCRing page {i+1}/{len(images)}...")
-        
-        # Convert image to bytes
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_b64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-        
-        # Extract text
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Extract ALL text from this document page. Return ONLY the text, no explanations."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-                ]
-            }],
-            max_tokens=1000,
-            temperature=0.1
-        )
-        
-        page_text = response.choices[0].message.content.strip()
-        if page_text:
-            all_text.append(f"--- Page {i+1} ---\n{page_text}")
+    doc = fitz.open(stream=pdf_data, filetype="pdf")
+    try:
+        classified = [classify_pdf_page(page) for page in doc]
+    finally:
+        doc.close()
+    ocr_pages = [
+        i for i, (kind, _, _) in enumerate(classified)
+        if OCR_ALL_PAGES or kind != "native"
+    ]
+    ocr_stats.add("pages_classified", len(classified))
+    ocr_stats.add("pages_ocr", len(ocr_pages))
+    ocr_stats.add("pages_native", len(classified) - len(ocr_pages))
+    print(f"  Page classifier: {len(ocr_pages)}/{len(classified)} pages need OCR")
     
-    return "\n\n".join(all_text)
+    # Mixed pages keep their native text; only their images are OCRed
+    region_pages = set() if OCR_ALL_PAGES else {i for i in ocr_pages if classified[i][0] == "mixed"}
+    ocr_texts = ocr_pdf_pages(pdf_data, ocr_pages, region_pages) if ocr_pages else {}
+    page_texts = []
+    for i, (kind, native_text, _) in enumerate(classified):
+        if OCR_ALL_PAGES and i in ocr_texts:
+            kind = "scanned"
+        page_text = merge_page_text(kind, native_text, ocr_texts.get(i))
+        if page_text:
+            page_texts.append(f"--- Page {i+1} ---\n{page_text}")
+    return "\n\n".join(page_texts)
 
 # ---------------- RUN ----------------
 if __name__ == "__main__":
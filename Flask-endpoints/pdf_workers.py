@@ -0,0 +1,79 @@
+"""
+Page-range PDF extraction run inside worker processes.
+
+Kept separate from main.py so spawned workers import only PyMuPDF/pdfplumber,
+not the embedding models, database pools and API clients main.py sets up at
+import time. The parent writes the PDF to a temp file once and each worker
+reopens the temp file by path, so no document bytes are pickled to them; only
+the extracted pages come back.
+"""
+import time
+
+import fitz  # PyMuPDF
+
+try:
+    import pdfplumber
+except ImportError:
+    pdfplumber = None
+
+# (colour components, alpha) -> PIL mode; other colourspaces are skipped
+PIXMAP_MODES = {(1, 0): "L", (1, 1): "LA", (3, 0): "RGB", (3, 1): "RGBA"}
+
+
+def extract_page_range(path, start, end, engine="pymupdf"):
+    """
+    Extract pages [start, end) of the PDF at path. Returns a list of
+    {"page", "text", "images", "width", "height", "image_xrefs", "elapsed_ms"}
+    where images are (xref, mode, (width, height), samples) tuples the parent
+    turns into PIL images. Images are deduplicated by xref within the range.
+    """
+    pages = []
+    seen_xrefs = set()
+    plumber = None
+    doc = fitz.open(path)
+    try:
+        if engine == "pdfplumber" and pdfplumber is not None:
+            plumber = pdfplumber.open(path)
+
+        for page_num in range(start, min(end, len(doc))):
+            started = time.perf_counter()
+            page = doc[page_num]
+            try:
+                if plumber is not None:
+                    page_text = plumber.pages[page_num].extract_text() or ""
+                    plumber.pages[page_num].flush_cache()
+                else:
+                    page_text = page.get_text("text")
+            except Exception as text_error:
+                print(f"    Failed to extract text on page {page_num + 1}: {text_error}")
+                page_text = ""
+
+            images = []
+            xrefs = [img[0] for img in page.get_images()]
+            for xref in xrefs:
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                try:
+                    pix = fitz.Pixmap(doc, xref)
+                    mode = PIXMAP_MODES.get((pix.n - pix.alpha, pix.alpha))
+                    if mode is not None:
+                        images.append((xref, mode, (pix.width, pix.height), pix.samples))
+                    pix = None  # Free memory
+                except Exception as img_error:
+                    print(f"    Failed to extract image xref {xref} on page {page_num + 1}: {img_error}")
+
+            pages.append({
+                "page": page_num + 1,
+                "text": page_text,
+                "images": images,
+                "width": round(page.rect.width, 1),
+                "height": round(page.rect.height, 1),
+                "image_xrefs": xrefs,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+            })
+    finally:
+        if plumber is not None:
+            plumber.close()
+        doc.close()
+    return pages
@@ -0,0 +1,120 @@
+"""
+Answer cache vs chat history in /ask.
+
+    python -m pytest tests/test_answer_cache.py
+
+The follow-up heuristic runs anywhere. The /ask tests import main, which loads
+the embedding models and connects to the database from the service's DB_*
+environment at import time, so they are skipped where that stack is missing.
+The cache, history, embeddings and Groq are replaced with in-memory fakes; no
+rows are written.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_context import is_follow_up_question
+
+UNRELATED_HISTORY = [
+    {"question": "What is a linked list?", "answer": "A chain of nodes.", "timestamp": "2026-01-01T10:00:00"},
+    {"question": "How does quicksort pick a pivot?", "answer": "Often the middle element.", "timestamp": "2026-01-01T10:01:00"},
+]
+
+
+@pytest.mark.parametrize("question", [
+    "What is gradient descent?",
+    "Summarize chapter 3",
+    "Explain the difference between TCP and UDP in the lecture notes",
+    "What does the continue statement do in Python loops?",
+])
+def test_standalone_questions_are_not_follow_ups(question):
+    assert not is_follow_up_question(question)
+
+
+@pytest.mark.parametrize("question", [
+    "and what about UDP?",
+    "Why?",
+    "Can you explain that more simply?",
+    "Why is it slower?",
+    "What did you mention about caching earlier?",
+    "Give me another example",
+])
+def test_referential_questions_are_follow_ups(question):
+    assert is_follow_up_question(question)
+
+
+@pytest.fixture
+def ask_app(monkeypatch):
+    for module in ("fastapi", "fitz", "numpy", "langchain_postgres", "sentence_transformers"):
+        pytest.importorskip(module)
+    if not os.environ.get("DB_HOST"):
+        pytest.skip("main connects to the database at import time; DB_HOST is not set")
+    import main
+
+    cache = []
+    calls = {"llm": 0, "history": 0}
+
+    def find_cached_answer(file_ids, question_embedding):
+        for entry in cache:
+            if entry["file_ids"] == sorted(file_ids) and entry["embedding"] == question_embedding:
+                return {"question": entry["question"], "answer": entry["answer"],
+                        "generation_ms": 100.0, "similarity": 1.0}
+        return None
+
+    def store_cached_answer(file_ids, question, question_embedding, answer, generation_ms):
+        cache.append({"file_ids": sorted(file_ids), "question": question,
+                      "embedding": question_embedding, "answer": answer})
+
+    def get_chat_history(file_ids, limit=10):
+        calls["history"] += 1
+        return UNRELATED_HISTORY[:limit]
+
+    class FakeGateway:
+        def chat(self, messages, **kwargs):
+            calls["llm"] += 1
+            message = type("Message", (), {"content": f"answer {calls['llm']}"})
+            return type("Response", (), {"choices": [type("Choice", (), {"message": message})]})
+
+    monkeypatch.setattr(main, "find_cached_answer", find_cached_answer)
+    monkeypatch.setattr(main, "store_cached_answer", store_cached_answer)
+    monkeypatch.setattr(main, "get_chat_history", get_chat_history)
+    monkeypatch.setattr(main, "save_chat_history", lambda file_id, question, answer: None)
+    monkeypatch.setattr(main, "get_text_query_embedding", lambda question: [float(len(question)), 1.0])
+    monkeypatch.setattr(main, "build_ask_messages",
+                        lambda question, file_ids, chat_history: ([], {"text": [], "images": []}))
+    monkeypatch.setattr(main, "context_debug_info", lambda packed: {})
+    monkeypatch.setattr(main, "llm_gateway", FakeGateway())
+    return main, calls
+
+
+def ask(main, question):
+    response = main.ask(main.AskRequest(question=question, file_ids=["file-a"]))
+    return json.loads(response.body)
+
+
+def test_repeat_question_after_unrelated_history_is_served_from_cache(ask_app):
+    main, calls = ask_app
+    first = ask(main, "What is gradient descent?")
+    ask(main, "How does backpropagation work?")
+    repeat = ask(main, "What is gradient descent?")
+
+    assert first["debug_info"]["cache_hit"] is False
+    assert repeat["debug_info"]["cache_hit"] is True
+    assert repeat["answer"] == first["answer"]
+    assert calls["llm"] == 2
+    assert calls["history"] == 0
+
+
+def test_follow_up_question_uses_history_and_skips_cache(ask_app):
+    main, calls = ask_app
+    first = ask(main, "Can you explain that more simply?")
+    repeat = ask(main, "Can you explain that more simply?")
+
+    assert first["debug_info"]["cache_hit"] is False
+    assert repeat["debug_info"]["cache_hit"] is False
+    assert calls["llm"] == 2
+    assert calls["history"] == 2